@@ -0,0 +1,400 @@
+"""Навантажувальний бенчмарк сервера гри "Скриньки".
+
+Режими:
+    python bench.py game --games 2000 [--record games.jsonl]
+        лише логіка Game у процесі, без сокетів (мікробенчмарк правил і серіалізації);
+        --record зберігає журнали зіграних ігор для replay.py
+    python bench.py log --log games.jsonl
+        те саме, але дії гравців беруться з журналу справжніх ігор (GAME_LOG сервера)
+    python bench.py ws --rooms 50 --players 4
+        повний протокол через WebSocket: сервер піднімається локально, боти грають у кімнатах
+    python bench.py ws --url ws://host:8765 --rooms 50
+        те саме проти вже запущеного сервера
+    python bench.py smoke
+        сервер окремим процесом за HTTP-фронтом: сторінка, вхід, розрив і повернення
+        через клієнт aiohttp; код виходу 1, якщо щось не так або сервер залогував помилку
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import aiohttp
+import websockets
+
+import codec
+import replay
+import skrynky_webapp_render as server
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def report(title, elapsed, messages, latencies, cpu, extra=()):
+    print(f"== {title}")
+    print(f"   elapsed:        {elapsed:.2f} s")
+    print(f"   messages:       {messages} ({messages / elapsed:.0f} msg/s)")
+    print(f"   latency p50:    {percentile(latencies, 0.50) * 1000:.3f} ms")
+    print(f"   latency p99:    {percentile(latencies, 0.99) * 1000:.3f} ms")
+    print(f"   cpu/message:    {cpu / max(messages, 1) * 1e6:.1f} us")
+    for line in extra:
+        print(f"   {line}")
+
+
+class NullSocket:
+    """З'єднання, яке нічого не відправляє: flush серіалізує кадри, але без I/O."""
+
+    async def send(self, payload):
+        pass
+
+
+def play_turn(game, rng, latencies):
+    """Один хід скриптового бота, який бачить усі руки. Повертає кількість застосованих дій."""
+    asker = game.players[game.asking_player]
+    targets = [name for name in game.players if name != asker.name]
+    target = game.players[rng.choice(targets)]
+    ranks = [server.card_rank(card) for card in asker.hand] or [rng.randrange(len(server.RANKS))]
+    rank = rng.choice(ranks)
+
+    actions = [(game.handle_ask_card, (asker.name, target.name, server.RANKS[rank]))]
+    count = target.hand.rank_count(rank)
+    actions.append((game.handle_ask_response, (target.name, 'yes' if count else 'no')))
+    if count:
+        guess = count if rng.random() < 0.6 else rng.randint(1, 3)
+        actions.append((game.handle_guess_count, (asker.name, guess)))
+        if guess == count:
+            suits = server.suits_of(target.hand.suit_mask(rank))
+            if rng.random() > 0.5:
+                suits = set(rng.sample(server.SUITS, count))
+            actions.append((game.handle_guess_suits, (asker.name, list(suits))))
+
+    for action, args in actions:
+        started = time.perf_counter()
+        action(*args)
+        latencies.append(time.perf_counter() - started)
+    return len(actions)
+
+
+async def bench_game(args):
+    rng = random.Random(args.seed)
+    latencies = []
+    messages = 0
+    journals = []
+    started, cpu_started = time.perf_counter(), time.process_time()
+    for i in range(args.games):
+        game = server.Game(seed=rng.randrange(2 ** 63))
+        for p in range(args.players):
+            game.add_player(f"bot{p}", NullSocket())
+        game.start_game()
+        await game.flush()
+        for _ in range(args.max_turns):
+            if not game.game_started:
+                break
+            messages += play_turn(game, rng, latencies)
+            await game.flush()
+        journals.append(game.journal)
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as log_file:
+            for i, journal in enumerate(journals):
+                log_file.write(codec.dumps({'room': f"bench-{i}", 'events': journal}) + '\n')
+
+    # Пам'ять однієї кімнати в розпал гри
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    rooms = []
+    for i in range(100):
+        game = server.Game(seed=i)
+        for p in range(args.players):
+            game.add_player(f"bot{p}", NullSocket())
+        game.start_game()
+        await game.flush()
+        rooms.append(game)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    per_room = sum(stat.size_diff for stat in after.compare_to(before, 'filename')) / len(rooms)
+
+    report("in-process Game", elapsed, messages, latencies, cpu, [
+        f"games:          {args.games} ({args.games / elapsed:.0f} games/s)",
+        f"memory/room:    {per_room / 1024:.1f} KiB",
+    ])
+
+
+async def bench_log(args):
+    games = replay.load(args.log)
+    latencies = []
+    messages = 0
+    started, cpu_started = time.perf_counter(), time.process_time()
+    for room_id, events in games:
+        game = replay.start_from(events, NullSocket())
+        await game.flush()
+        for event in events:
+            action_started = time.perf_counter()
+            if replay.apply_input(game, event):
+                latencies.append(time.perf_counter() - action_started)
+                messages += 1
+                await game.flush()
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+
+    report("recorded games", elapsed, messages, latencies, cpu, [
+        f"games:          {len(games)} ({len(games) / elapsed:.0f} games/s)",
+    ])
+
+
+class BotClient:
+    """Бот, що грає через протокол сервера і знає лише те, що бачить гравець."""
+
+    def __init__(self, name, room, rng, stats):
+        self.name = name
+        self.room = room
+        self.rng = rng
+        self.stats = stats
+        self.state = None
+        self.sent_at = None
+        self.done = asyncio.Event()
+
+    async def send(self, websocket, message):
+        self.sent_at = time.perf_counter()
+        self.stats['messages'] += 1
+        await websocket.send(json.dumps(message))
+
+    async def run(self, url, ready, start):
+        async with websockets.connect(url, max_size=None) as websocket:
+            await self.send(websocket, {'type': 'join', 'name': self.name, 'room': self.room})
+            ready.set()
+            if start is not None:
+                await start.wait()
+                await self.send(websocket, {'type': 'start_game'})
+            async for raw in websocket:
+                if self.sent_at is not None:
+                    self.stats['latencies'].append(time.perf_counter() - self.sent_at)
+                    self.sent_at = None
+                await self.on_frame(websocket, json.loads(raw))
+                if self.done.is_set():
+                    return
+
+    async def on_frame(self, websocket, frame):
+        prompt = None
+        state_changed = False
+        for event in frame.get('events', [frame]):
+            kind = event['type']
+            if kind == 'update_state':
+                self.state = event['state']
+                state_changed = True
+            elif kind == 'state_patch':
+                for op in event['patch']:
+                    apply_op(self.state, op)
+                state_changed = True
+            elif kind in ('ask_response_needed', 'guess_count_needed', 'guess_suits_needed'):
+                prompt = event
+            elif kind == 'game_over':
+                self.done.set()
+                return
+
+        hand = self.state['my_hand'] if self.state else []
+        if prompt is not None and prompt['type'] == 'ask_response_needed':
+            has = any(card[:-1] == prompt['card_rank'] for card in hand)
+            await self.send(websocket, {'type': 'ask_response', 'response': 'yes' if has else 'no'})
+        elif prompt is not None and prompt['type'] == 'guess_count_needed':
+            await self.send(websocket, {'type': 'guess_count', 'count': self.rng.randint(1, 2)})
+        elif prompt is not None and prompt['type'] == 'guess_suits_needed':
+            mine = {card[-1] for card in hand if card[:-1] == prompt['card_rank']}
+            free = [suit for suit in server.SUITS if suit not in mine]
+            count = min(prompt['correct_count'], len(free))
+            await self.send(websocket, {'type': 'guess_suits', 'suits': self.rng.sample(free, count)})
+        elif state_changed and self.state['game_started'] and self.state['current_turn'] == self.name:
+            others = [p['name'] for p in self.state['players'] if p['name'] != self.name]
+            rank = self.rng.choice(hand)[:-1] if hand else self.rng.choice(server.RANKS)
+            await self.send(websocket, {'type': 'ask_card', 'target': self.rng.choice(others), 'card_rank': rank})
+
+
+def apply_op(state, op):
+    keys = op['path'].split('/')[1:]
+    last = keys.pop()
+    parent = state
+    for key in keys:
+        parent = parent[int(key)] if isinstance(parent, list) else parent[key]
+    if isinstance(parent, list):
+        last = int(last)
+    if op['op'] == 'remove':
+        del parent[last]
+    else:
+        parent[last] = op['value']
+
+
+async def run_room(url, room, players, rng, stats):
+    bots = [BotClient(f"bot{i}", room, random.Random(rng.random()), stats) for i in range(players)]
+    start = asyncio.Event()
+    ready = [asyncio.Event() for _ in bots]
+    tasks = [asyncio.create_task(bots[0].run(url, ready[0], start))]
+    await ready[0].wait()
+    # Решта гравців приєднується після адміна кімнати
+    for bot, event in zip(bots[1:], ready[1:]):
+        tasks.append(asyncio.create_task(bot.run(url, event, None)))
+        await event.wait()
+    await asyncio.sleep(0.05)
+    start.set()
+    await asyncio.gather(*tasks)
+    stats['games'] += 1
+
+
+async def bench_ws(args):
+    stats = {'messages': 0, 'latencies': [], 'games': 0}
+    rng = random.Random(args.seed)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    server_context = None
+    url = args.url
+    if url is None:
+        # Боти відповідають миттєво, тож ліміт вхідних повідомлень для людей їх би гальмував
+        server.INBOUND_RATE = server.INBOUND_BURST = 10 ** 6
+        server_context = websockets.serve(server.handler, "127.0.0.1", 0, max_size=None)
+        local = await server_context.__aenter__()
+        url = f"ws://127.0.0.1:{local.sockets[0].getsockname()[1]}"
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(run_room(url, f"bench-{i}", args.players, rng, stats) for i in range(args.rooms))),
+            args.timeout,
+        )
+    finally:
+        elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+        if server_context is not None:
+            await server_context.__aexit__(None, None, None)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    report("WebSocket protocol", elapsed, stats['messages'], stats['latencies'], cpu, [
+        f"rooms finished: {stats['games']}/{args.rooms}",
+        # У локальному режимі боти і сервер ділять процес, тож це верхня межа
+        f"peak RSS/room:  {(rss_after - rss_before) / max(args.rooms, 1):.1f} KiB (server and bots together)",
+    ])
+
+
+async def _events_until(ws, kind, timeout=3):
+    """Події з кадрів сервера до першої події kind включно."""
+    events = []
+    while not any(event['type'] == kind for event in events):
+        message = await ws.receive(timeout=timeout)
+        if message.type != aiohttp.WSMsgType.TEXT:
+            raise ConnectionError(f"{kind} not received: {message.type.name}")
+        frame = json.loads(message.data)
+        events.extend(frame.get('events', [frame]))
+    return events
+
+
+async def _smoke_session(base, check):
+    async with aiohttp.ClientSession(auto_decompress=False) as http:
+        for _ in range(100):
+            try:
+                page = await http.get(base, headers={'Accept-Encoding': 'gzip'})
+                break
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.1)
+        else:
+            check(False, "server is listening")
+            return
+        body = await page.read()
+        check(page.status == 200 and page.headers.get('Content-Encoding') == 'gzip' and body, "page served gzipped")
+        cached = await http.get(base, headers={'If-None-Match': page.headers.get('ETag', '')})
+        check(cached.status == 304, "page revalidates with 304")
+
+        a = await http.ws_connect(base)
+        b = await http.ws_connect(base)
+        await a.send_json({'type': 'join', 'name': 'a', 'room': 'smoke'})
+        joined = await _events_until(a, 'joined_room')
+        session = next(event['session'] for event in joined if event['type'] == 'joined_room')
+        await b.send_json({'type': 'join', 'name': 'b', 'room': 'smoke'})
+        await _events_until(b, 'joined_room')
+        await a.send_json({'type': 'start_game'})
+        await _events_until(b, 'log')
+        check(True, "two players joined and started a game")
+
+        # Повернення з нового з'єднання закриває старе, а розсилка решті гравців не переривається
+        a2 = await http.ws_connect(base)
+        await a2.send_json({'type': 'resume', 'name': 'a', 'room': 'smoke', 'session': session, 'last_seq': 0})
+        resumed = await _events_until(a2, 'joined_room')
+        check(any(event.get('resumed') for event in resumed), "session resumed on a new connection")
+        # Кадри, що старе з'єднання ще не прочитало, йдуть перед закриттям
+        while (await a.receive(timeout=3)).type == aiohttp.WSMsgType.TEXT:
+            pass
+        check(a.close_code == 4000, f"old connection closed with 4000 (got {a.close_code})")
+        await a2.close()
+        events = await _events_until(b, 'log')
+        check(bool(events), "remaining player still receives frames after a disconnect")
+        await b.close()
+        await asyncio.sleep(0.2)
+
+
+async def bench_smoke(args):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    store = os.path.join(tempfile.mkdtemp(prefix="skrynky-smoke-"), "rooms.db")
+    # Знімки за інтервалом не встигнуть записатися: кімната має потрапити в сховище лише під час зупинки на SIGTERM
+    env = dict(os.environ, PORT=str(port), HTTP_FRONTEND="1", WORKERS="1", ROOM_STORE=store, SNAPSHOT_INTERVAL="600")
+    failures = []
+
+    def check(ok, what):
+        print(f"   {'ok  ' if ok else 'FAIL'} {what}")
+        if not ok:
+            failures.append(what)
+
+    print("== HTTP front end smoke test")
+    with tempfile.TemporaryFile() as server_log:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, server.__file__, env=env, stdout=server_log, stderr=server_log,
+        )
+        try:
+            await asyncio.wait_for(_smoke_session(f"http://127.0.0.1:{port}/", check), args.timeout)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            check(False, f"session completed ({e!r})")
+        finally:
+            process.terminate()
+            returncode = await process.wait()
+        check(returncode == 0, f"server stopped cleanly on SIGTERM (exit code {returncode})")
+        with sqlite3.connect(store) as connection:
+            saved = [room_id for room_id, in connection.execute("SELECT room_id FROM rooms")]
+        check(saved == ['smoke'], f"room snapshot written on shutdown ({saved})")
+        server_log.seek(0)
+        log = server_log.read().decode('utf-8', 'replace')
+    errors = [line for line in log.splitlines() if 'Traceback' in line or 'Error handling request' in line]
+    check(not errors, "server logged no errors")
+    if errors:
+        print(log)
+    raise SystemExit(1 if failures else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', choices=('game', 'log', 'ws', 'smoke'))
+    parser.add_argument('--games', type=int, default=1000, help="кількість ігор у режимі game")
+    parser.add_argument('--rooms', type=int, default=20, help="кількість одночасних кімнат у режимі ws")
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--max-turns', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--url', help="адреса вже запущеного сервера замість локального")
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--record', help="у режимі game: записати журнали ігор у цей JSONL-файл")
+    parser.add_argument('--log', help="у режимі log: JSONL-журнал ігор для відтворення")
+    args = parser.parse_args()
+
+    server.logger.setLevel("WARNING")
+    modes = {'game': bench_game, 'log': bench_log, 'ws': bench_ws, 'smoke': bench_smoke}
+    asyncio.run(modes[args.mode](args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""Кодек повідомлень WebSocket для сервера "Скриньки".
+
+JSON кодується в UTF-8 без \\uXXXX-екранування (кирилиця та ♥♦♣♠ займають
+удвічі менше місця). Якщо встановлено orjson або msgspec, використовується
+швидкий бекенд, інакше - стандартний json. Вибір можна задати через CODEC.
+
+Вхідні повідомлення перевіряються на розмір і на відповідність типізованим
+структурам INBOUND; усе зайве відкидається ще до черги кімнати.
+"""
+import json
+import os
+from typing import NamedTuple
+
+# Найбільше вхідне повідомлення, байти; справжні повідомлення клієнта - десятки байтів
+MAX_MESSAGE_BYTES = int(os.environ.get("MAX_MESSAGE_BYTES", "4096"))
+
+
+class CodecError(ValueError):
+    """Вхідне повідомлення не вдалося розібрати або воно не відповідає схемі."""
+
+
+def _stdlib_backend():
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    return 'json', encoder.encode, json.loads, ValueError
+
+
+def _orjson_backend():
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+    return 'orjson', dumps, orjson.loads, orjson.JSONDecodeError
+
+
+def _msgspec_backend():
+    import msgspec
+
+    encoder = msgspec.json.Encoder()
+    decoder = msgspec.json.Decoder()
+
+    def dumps(obj):
+        return encoder.encode(obj).decode('utf-8')
+    return 'msgspec', dumps, decoder.decode, msgspec.DecodeError
+
+
+_BACKENDS = {'orjson': _orjson_backend, 'msgspec': _msgspec_backend, 'json': _stdlib_backend}
+
+
+def _select_backend(preferred):
+    # Невідома назва - помилка конфігурації, а не відсутній пакет: не підміняємо її мовчки
+    if preferred and preferred not in _BACKENDS:
+        raise ValueError(f"Unknown CODEC {preferred!r}; expected one of: {', '.join(_BACKENDS)}")
+    order = [preferred] if preferred else ['orjson', 'msgspec', 'json']
+    for name in order:
+        try:
+            return _BACKENDS[name]()
+        except ImportError:
+            continue
+    return _stdlib_backend()
+
+
+BACKEND, dumps, _loads, _DecodeError = _select_backend(os.environ.get("CODEC", ""))
+
+
+def loads(data):
+    try:
+        return _loads(data)
+    except _DecodeError as e:
+        raise CodecError(f"Invalid JSON: {e}") from None
+
+
+class Template:
+    """Повідомлення з незмінним типом і порядком полів.
+
+    Ключі та тип закодовані заздалегідь, тож під час відправки кодуються
+    лише значення полів.
+    """
+
+    def __init__(self, message_type, *fields):
+        self.head = '{"type":' + dumps(message_type)
+        self.parts = [',' + dumps(field) + ':' for field in fields]
+
+    def render(self, *values):
+        """Збирає повідомлення з уже закодованих значень полів."""
+        return self.head + ''.join(part + value for part, value in zip(self.parts, values)) + '}'
+
+    def encode(self, *values):
+        """Як render, але значення ще не закодовані."""
+        return self.render(*(dumps(value) for value in values))
+
+
+LOG = Template('log', 'message')
+BATCH = Template('batch', 'seq', 'events')
+STATE_PATCH = Template('state_patch', 'base', 'version', 'patch')
+UPDATE_STATE = Template('update_state', 'version', 'state')
+_BATCH_SEQ_PREFIX = BATCH.head + BATCH.parts[0]
+
+
+def batch_seq(payload):
+    """Номер останньої події в пакеті, закодованому BATCH, або None для інших кадрів."""
+    if not payload.startswith(_BATCH_SEQ_PREFIX):
+        return None
+    start = len(_BATCH_SEQ_PREFIX)
+    return int(payload[start:payload.index(',', start)])
+
+
+class Join(NamedTuple):
+    name: str
+    room: str
+
+
+class Resume(NamedTuple):
+    name: str
+    room: str
+    session: str
+    last_seq: int = 0
+
+
+class StartGame(NamedTuple):
+    pass
+
+
+class AddBot(NamedTuple):
+    pass
+
+
+class AskCard(NamedTuple):
+    target: str
+    card_rank: str
+
+
+class AskResponse(NamedTuple):
+    response: str
+
+
+class GuessCount(NamedTuple):
+    count: int
+
+
+class GuessSuits(NamedTuple):
+    suits: list
+
+
+class Resync(NamedTuple):
+    pass
+
+
+class ListRooms(NamedTuple):
+    pass
+
+
+class QuickJoin(NamedTuple):
+    name: str
+
+
+INBOUND = {
+    'join': Join,
+    'resume': Resume,
+    'start_game': StartGame,
+    'add_bot': AddBot,
+    'ask_card': AskCard,
+    'ask_response': AskResponse,
+    'guess_count': GuessCount,
+    'guess_suits': GuessSuits,
+    'resync': Resync,
+    'list_rooms': ListRooms,
+    'quick_join': QuickJoin,
+}
+
+# Обмеження довжини рядкових полів (ім'я, кімната, токен сесії тощо)
+MAX_STRING = 64
+
+
+def _check(struct, field, value):
+    expected = struct.__annotations__[field]
+    # bool - підклас int, але кількість карт не може бути True
+    if not isinstance(value, expected) or isinstance(value, bool):
+        raise CodecError(f"Field '{field}' must be {expected.__name__}.")
+    if expected is str and not 0 < len(value) <= MAX_STRING:
+        raise CodecError(f"Field '{field}' must be 1..{MAX_STRING} characters.")
+    if expected is list and (len(value) > 4 or not all(isinstance(item, str) for item in value)):
+        raise CodecError(f"Field '{field}' must be a list of at most 4 strings.")
+    return value
+
+
+def decode_inbound(raw):
+    """Розбирає й перевіряє вхідне повідомлення; повертає dict лише з полями схеми."""
+    if len(raw) > MAX_MESSAGE_BYTES:
+        raise CodecError("Message too large.")
+    data = loads(raw)
+    if not isinstance(data, dict):
+        raise CodecError("Message must be a JSON object.")
+    kind = data.get('type')
+    struct = INBOUND.get(kind) if isinstance(kind, str) else None
+    if struct is None:
+        raise CodecError(f"Unknown message type: {kind!r}.")
+
+    message = {'type': data['type']}
+    for field in struct._fields:
+        if field in data:
+            message[field] = _check(struct, field, data[field])
+        elif field in struct._field_defaults:
+            message[field] = struct._field_defaults[field]
+        else:
+            raise CodecError(f"Missing field '{field}'.")
+    return message
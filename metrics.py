@@ -0,0 +1,225 @@
+"""Метрики у форматі Prometheus та вибірковий профайлер для сервера "Скриньки".
+
+Реєстр живе в пам'яті процесу; set_up_endpoint() віддає його через aiohttp:
+    GET /metrics                     - лічильники та гістограми у текстовому форматі Prometheus
+    GET /debug/profile?seconds=10    - згорнуті стеки (flamegraph) гарячих місць, якщо PROFILER=1
+"""
+import asyncio
+import bisect
+import collections
+import functools
+import math
+import os
+import sys
+import threading
+import time
+
+from aiohttp import web
+
+# Межі кошиків гістограм затримки, секунди
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _label_text(label_names, label_values):
+    if not label_names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(label_names, label_values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = collections.defaultdict(float)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in sorted(self.values.items()):
+            yield f"{self.name}{_label_text(self.labels, label_values)} {value:g}"
+
+
+class Gauge:
+    """Значення береться з функції в момент збору метрик - на гарячому шляху нічого не рахується."""
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.callback():g}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Для кожного набору міток: [лічильники кошиків..., +Inf], сума, кількість
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                labels = _label_text(self.labels + ('le',), label_values + (bound,))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _label_text(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {total:g}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, callback):
+        return self.register(Gauge(name, help_text, callback))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+messages_in = registry.counter('skrynky_messages_in_total', "Inbound messages by type.", ('type',))
+messages_out = registry.counter('skrynky_messages_out_total', "Outbound events by type (before batching).", ('type',))
+frames_out = registry.counter('skrynky_frames_out_total', "WebSocket frames sent.")
+bytes_sent = registry.counter('skrynky_bytes_sent_total', "UTF-8 bytes sent in WebSocket frames.")
+send_failures = registry.counter('skrynky_send_failures_total', "Failed sends by reason.", ('reason',))
+slow_clients = registry.counter('skrynky_slow_clients_total', "Sends that hit SEND_TIMEOUT.")
+rate_limited = registry.counter('skrynky_rate_limited_total', "Inbound messages dropped by the rate limiter.")
+dropped_frames = registry.counter('skrynky_dropped_frames_total', "Outbound frames dropped on outbox overflow.")
+evictions = registry.counter('skrynky_evictions_total', "Clients disconnected for staying over the outbox high-water mark.")
+send_seconds = registry.histogram('skrynky_send_seconds', "Time to send one frame to one client.")
+fanout_seconds = registry.histogram('skrynky_fanout_seconds', "Time from queuing a room frame to writing it to the client.")
+command_seconds = registry.histogram('skrynky_command_seconds', "Room actor time per command.", ('type',))
+call_seconds = registry.histogram('skrynky_call_seconds', "Time spent in instrumented game methods.", ('method',))
+
+
+# Вимикає timed для пакетних симуляцій, де гістограми лише заважають
+enabled = True
+
+
+def timed(method):
+    """Декоратор: записує тривалість виклику в skrynky_call_seconds{method=...}."""
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return method(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            call_seconds.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+class SamplingProfiler:
+    """Знімає стек головного потоку з частотою hz і рахує згорнуті стеки.
+
+    Працює в окремому потоці лише протягом запиту, тож без запиту не коштує нічого.
+    """
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.lock = threading.Lock()
+
+    def sample(self, seconds, hz):
+        stacks = collections.Counter()
+        interval = 1.0 / hz
+        deadline = time.monotonic() + seconds
+        with self.lock:
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(self.thread_id)
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if names:
+                    stacks[';'.join(reversed(names))] += 1
+                time.sleep(interval)
+        return stacks
+
+
+async def _metrics_view(request):
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+
+def query_number(request, name, default, low, high, kind=float):
+    """Числовий параметр запиту, обмежений межами [low, high]; некоректне значення - 400."""
+    raw = request.query.get(name)
+    if raw is None:
+        return default
+    try:
+        value = kind(raw)
+    except ValueError:
+        value = None
+    if value is None or not math.isfinite(value):
+        raise web.HTTPBadRequest(text=f"Parameter {name} must be a number.")
+    return min(max(value, low), high)
+
+
+async def _profile_view(request):
+    profiler = request.app['profiler']
+    seconds = query_number(request, 'seconds', 10, 0.1, 60)
+    hz = query_number(request, 'hz', 100, 1, 1000)
+    if profiler.lock.locked():
+        raise web.HTTPConflict(text="Profiler is already running.")
+    stacks = await asyncio.to_thread(profiler.sample, seconds, hz)
+    body = '\n'.join(f"{stack} {count}" for stack, count in stacks.most_common())
+    return web.Response(text=body + '\n', content_type='text/plain', charset='utf-8')
+
+
+def set_up_endpoint(app, profiler=False):
+    """Додає /metrics (і /debug/profile, якщо profiler) до aiohttp-застосунку."""
+    app.router.add_get('/metrics', _metrics_view)
+    if profiler:
+        app['profiler'] = SamplingProfiler(threading.get_ident())
+        app.router.add_get('/debug/profile', _profile_view)
+    return app
+
+
+async def start_endpoint(host, port, profiler=False, app=None):
+    """Запускає окремий HTTP-сервер метрик (на app з додатковими маршрутами, якщо задано) і повертає його runner."""
+    app = set_up_endpoint(app if app is not None else web.Application(), profiler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,243 @@
+"""Журнал подій гри "Скриньки" та його відтворення.
+
+Кожна гра записується в Game.journal як послідовність кортежів:
+    ('seed', seed колоди, [гравці в порядку ходу])
+    ('deal', гравець, маска руки)
+    ('ask', хто питає, у кого, ранг)
+    ('response', гравець, True/False)
+    ('guess_count', гравець, кількість)
+    ('guess_suits', гравець, маска названих мастей, маска переданих карт)
+    ('draw', гравець, карта)
+    ('set_collected', гравець, ранг)
+    ('turn_change', гравець)
+    ('leave', гравець)
+Ранг - індекс у RANKS, карта - id (ранг * 4 + масть), як у skrynky_webapp_render.
+
+replay() відновлює стан Game після будь-якої кількості подій, просто застосовуючи
+записане, без правил гри - тож журнал придатний для розбору суперечок.
+rerun() проганяє лише дії гравців через поточні правила Game і повертає новий
+журнал; розбіжність з оригіналом означає, що зміна правил змінила перебіг гри.
+
+    python replay.py games.jsonl                     перевірити всі ігри поточними правилами
+    python replay.py games.jsonl --room R --at N     стан гри кімнати R після N подій
+"""
+import argparse
+import itertools
+import random
+import time
+
+import codec
+from skrynky_webapp_render import RANKS, SUITS, Deck, Game, Hand, Player, logger
+
+
+def load(path):
+    """Читає JSONL-журнал ігор і повертає [(room_id, події)]; події - кортежі."""
+    games = []
+    with open(path, encoding='utf-8') as log_file:
+        for line in log_file:
+            if line.strip():
+                record = codec.loads(line)
+                games.append((record['room'], [tuple(event) for event in record['events']]))
+    return games
+
+
+def _seed(game, deck_seed, names):
+    for name in names:
+        game.players[name] = Player(name, None)
+    game.room_admin = names[0]
+    game.deck = Deck(random.Random(deck_seed))
+    game.game_started = True
+    game.asking_player = names[0]
+
+
+def _deal(game, name, mask):
+    game.players[name].hand = Hand.from_mask(mask)
+    game.deck.position += bin(mask).count('1')
+
+
+def _ask(game, name, target, rank):
+    game.asking_player, game.target_player, game.asked_rank = name, target, RANKS[rank]
+    game.phase = 'response'
+
+
+def _response(game, name, has_rank):
+    # На "ні" далі йдуть draw і turn_change
+    if has_rank:
+        game.phase = 'guess_count'
+
+
+def _guess_count(game, name, count):
+    # Якщо не вгадав, далі йдуть draw і turn_change
+    game.phase = 'guess_suits'
+
+
+def _guess_suits(game, name, guessed, taken):
+    if taken:
+        rank = RANKS.index(game.asked_rank)
+        game.players[name].hand.add_rank(rank, game.players[game.target_player].hand.take_rank(rank))
+        game.target_player = None
+        game.asked_rank = None
+        game.phase = 'ask'
+
+
+def _draw(game, name, card):
+    game.players[name].hand.add(card)
+    game.deck.position += 1
+
+
+def _set_collected(game, name, rank):
+    player = game.players[name]
+    player.hand.take_rank(rank)
+    player.collected_sets.append(RANKS[rank])
+    if sum(len(p.collected_sets) for p in game.players.values()) == len(RANKS):
+        game.game_started = False
+        game.finished = True
+
+
+def _turn_change(game, name):
+    game.current_turn_index = list(game.players).index(name)
+    game.asking_player = name
+    game.target_player = None
+    game.asked_rank = None
+    game.phase = 'ask'
+
+
+def _leave(game, name):
+    game.remove_player(name)
+
+
+_APPLY = {
+    'seed': _seed,
+    'deal': _deal,
+    'ask': _ask,
+    'response': _response,
+    'guess_count': _guess_count,
+    'guess_suits': _guess_suits,
+    'draw': _draw,
+    'set_collected': _set_collected,
+    'turn_change': _turn_change,
+    'leave': _leave,
+}
+
+
+def replay(events, upto=None):
+    """Game у стані після перших upto подій (усіх, якщо None)."""
+    game = Game()
+    applied = list(itertools.islice(events, upto))
+    for event in applied:
+        _APPLY[event[0]](game, *event[1:])
+    game.journal = applied
+    return game
+
+
+def suit_names(suit_mask):
+    """Назви мастей для маски з події guess_suits; біт поза мастями - невідома масть."""
+    return [SUITS[i] if i < len(SUITS) else '?' for i in range(len(SUITS) + 1) if suit_mask >> i & 1]
+
+
+def apply_input(game, event):
+    """Застосовує дію гравця з журналу через правила Game.
+
+    Як і Room.apply, ігнорує дію не від того гравця або не в тій фазі (назви подій
+    ходу збігаються з фазами Game); повертає, чи її застосовано.
+    """
+    kind, name = event[0], event[1]
+    if kind != 'leave' and kind != game.phase:
+        return False
+    if kind == 'ask' and name == game.asking_player:
+        game.handle_ask_card(name, event[2], RANKS[event[3]])
+    elif kind == 'response' and name == game.target_player:
+        game.handle_ask_response(name, 'yes' if event[2] else 'no')
+    elif kind == 'guess_count' and name == game.asking_player:
+        game.handle_guess_count(name, event[2])
+    elif kind == 'guess_suits' and name == game.asking_player:
+        game.handle_guess_suits(name, suit_names(event[2]))
+    elif kind == 'leave':
+        game.remove_player(name)
+    else:
+        return False
+    return True
+
+
+def start_from(events, websocket=None):
+    """Нова Game з тими самими гравцями та колодою, що й у першій події журналу."""
+    _, deck_seed, names = events[0]
+    game = Game()
+    for name in names:
+        game.add_player(name, websocket)
+    game.start_game(deck_seed)
+    return game
+
+
+def rerun(events):
+    """Проганяє дії гравців із журналу через поточні правила; повертає Game з новим журналом."""
+    game = start_from(events)
+    for event in events:
+        if event[0] in ('ask', 'response', 'guess_count', 'guess_suits', 'leave'):
+            apply_input(game, event)
+            # Повідомлення нікому не відправляються, тож не даємо їм накопичуватись
+            game._outbox.clear()
+    return game
+
+
+def first_divergence(expected, actual):
+    """Індекс першої події, що відрізняється, або None, якщо журнали однакові."""
+    for index, (a, b) in enumerate(itertools.zip_longest(expected, actual)):
+        if a != b:
+            return index
+    return None
+
+
+def describe(game):
+    return {
+        'game_started': game.game_started,
+        'current_turn': game.asking_player,
+        'target': game.target_player,
+        'asked_rank': game.asked_rank,
+        'deck_size': len(game.deck),
+        'players': {p.name: {'hand': p.hand.to_strings(), 'sets': p.collected_sets} for p in game.players.values()},
+    }
+
+
+def check(games):
+    started = time.perf_counter()
+    for room_id, events in games:
+        replay(events)
+    replay_elapsed = time.perf_counter() - started
+
+    mismatches = 0
+    started = time.perf_counter()
+    for room_id, events in games:
+        index = first_divergence(events, rerun(events).journal)
+        if index is not None:
+            mismatches += 1
+            recorded = events[index] if index < len(events) else None
+            print(f"{room_id}: diverges at event {index}: recorded {recorded}")
+    rerun_elapsed = time.perf_counter() - started
+
+    count = max(len(games), 1)
+    print(f"replay: {len(games)} games, {count / max(replay_elapsed, 1e-9):.0f} games/s")
+    print(f"rerun:  {len(games)} games, {count / max(rerun_elapsed, 1e-9):.0f} games/s, {mismatches} diverged")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', help="JSONL-журнал ігор (GAME_LOG сервера або bench.py game --record)")
+    parser.add_argument('--room', help="показати стан гри цієї кімнати")
+    parser.add_argument('--at', type=int, help="кількість подій, після яких показати стан")
+    args = parser.parse_args()
+
+    logger.setLevel("WARNING")
+    games = load(args.log)
+    if args.room is None:
+        raise SystemExit(1 if check(games) else 0)
+    for room_id, events in games:
+        if room_id == args.room:
+            print(codec.dumps(describe(replay(events, args.at))))
+            return
+    raise SystemExit(f"Room {args.room} not found in {args.log}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Пакетна гра ботів проти ботів без сокетів.
+
+Ігри розподіляються пачками між процесами пулу; кожен процес грає свої ігри
+в headless-режимі Game і повертає лише зведену статистику, тож мільйони ігор
+не тримаються в пам'яті.
+
+    python simulate.py --games 1000000 --players 4
+    python simulate.py --games 1000 --players 3 --record games.jsonl
+        (журнали ігор для replay.py і bench.py log)
+"""
+import argparse
+import collections
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import codec
+import metrics
+import skrynky_webapp_render as server
+
+
+def play_game(seed, players, max_actions):
+    """Одна гра ботів; повертає (Game, кількість дій)."""
+    game = server.Game(seed=seed, headless=True)
+    for _ in range(players):
+        game.add_bot()
+    game.start_game()
+    actions = 0
+    while game.game_started and actions < max_actions and game.play_bot():
+        actions += 1
+    return game, actions
+
+
+def run_chunk(first_seed, count, players, max_actions, record):
+    """Грає count ігор поспіль; повертає (Counter зі статистикою, журнали, якщо record)."""
+    metrics.enabled = False
+    server.logger.setLevel("WARNING")
+    stats = collections.Counter()
+    journals = []
+    for seed in range(first_seed, first_seed + count):
+        game, actions = play_game(seed, players, max_actions)
+        stats['games'] += 1
+        stats['actions'] += actions
+        stats['finished' if game.finished else 'unfinished'] += 1
+        scores = [len(p.collected_sets) for p in game.players.values()]
+        best = max(scores)
+        winners = [seat for seat, score in enumerate(scores) if score == best]
+        if len(winners) > 1:
+            stats['ties'] += 1
+        for seat in winners:
+            stats['wins', seat] += 1
+        for seat, score in enumerate(scores):
+            stats['sets', seat] += score
+        if record:
+            journals.append((f"sim-{seed}", game.journal))
+    return stats, journals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--players', type=int, default=4, choices=range(2, server.MAX_PLAYERS + 1))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk', type=int, default=500, help="скільки ігор процес грає за одне завдання")
+    parser.add_argument('--max-actions', type=int, default=5000, help="ліміт дій на гру, після якого вона вважається незавершеною")
+    parser.add_argument('--seed', type=int, default=0, help="seed першої гри; наступні йдуть підряд")
+    parser.add_argument('--record', help="записати журнали ігор у цей JSONL-файл")
+    args = parser.parse_args()
+
+    chunks = [(first, min(args.chunk, args.seed + args.games - first))
+              for first in range(args.seed, args.seed + args.games, args.chunk)]
+    stats = collections.Counter()
+    log_file = open(args.record, 'w', encoding='utf-8') if args.record else None
+    started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            play_chunk = functools.partial(run_chunk, players=args.players, max_actions=args.max_actions,
+                                           record=log_file is not None)
+            for chunk_stats, journals in pool.map(play_chunk, *zip(*chunks)):
+                stats.update(chunk_stats)
+                for room_id, journal in journals:
+                    log_file.write(codec.dumps({'room': room_id, 'events': journal}) + '\n')
+    finally:
+        if log_file is not None:
+            log_file.close()
+    elapsed = time.perf_counter() - started
+
+    games = max(stats['games'], 1)
+    print(f"== self-play: {args.players} bots, {args.workers} workers")
+    print(f"   elapsed:        {elapsed:.2f} s")
+    print(f"   games:          {stats['games']} ({stats['games'] / elapsed:.0f} games/s)")
+    print(f"   finished:       {stats['finished'] / games:.1%} ({stats['unfinished']} hit --max-actions)")
+    print(f"   actions/game:   {stats['actions'] / games:.1f}")
+    print(f"   ties:           {stats['ties'] / games:.1%}")
+    print("   wins by seat:   " + "  ".join(f"{seat}: {stats['wins', seat] / games:.1%}" for seat in range(args.players)))
+    print("   sets by seat:   " + "  ".join(f"{seat}: {stats['sets', seat] / games:.2f}" for seat in range(args.players)))
+
+
+if __name__ == "__main__":
+    main()
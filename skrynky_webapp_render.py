@@ -1,52 +1,599 @@
 import asyncio
-import json
+import itertools
+import multiprocessing
 import random
+import secrets
+import signal
+import sqlite3
+import sys
 import websockets
+import websockets.exceptions
 import os
 import logging
+import time
+import zlib
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+import codec
+import metrics
+import webapp
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-class Deck:
+# Скільки секунд чекаємо на відправку одному гравцю, перш ніж вважати його "повільним"
+SEND_TIMEOUT = float(os.environ.get("SEND_TIMEOUT", "5"))
+# Шлях до SQLite-файлу зі станом кімнат (порожній - без збереження) та період запису знімків
+ROOM_STORE = os.environ.get("ROOM_STORE", "")
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", "2"))
+# Скільки секунд місце відключеного гравця чекає на повернення і скільки подій пам'ятає кімната
+RESUME_GRACE = float(os.environ.get("RESUME_GRACE", "60"))
+REPLAY_BUFFER = int(os.environ.get("REPLAY_BUFFER", "256"))
+# Локальний HTTP-ендпоінт метрик (порожній порт - вимкнено) і вибірковий профайлер на ньому
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.environ.get("METRICS_PORT", "")
+PROFILER = os.environ.get("PROFILER", "") == "1"
+# Ліміт вхідних повідомлень на з'єднання: стала швидкість (за секунду) і допустимий сплеск
+INBOUND_RATE = float(os.environ.get("INBOUND_RATE", "10"))
+INBOUND_BURST = int(os.environ.get("INBOUND_BURST", "20"))
+# Межа вихідної черги клієнта (кадри та символи) і скільки секунд клієнт може бути над нею до відключення
+OUTBOX_HIGH_WATER = int(os.environ.get("OUTBOX_HIGH_WATER", "64"))
+OUTBOX_MAX_CHARS = int(os.environ.get("OUTBOX_MAX_CHARS", str(1 << 20)))
+EVICT_AFTER = float(os.environ.get("EVICT_AFTER", "30"))
+# Скільки кімнат тримає процес і через скільки секунд без команд кімната закривається (після кінця гри - швидше)
+MAX_ROOMS = int(os.environ.get("MAX_ROOMS", "10000"))
+ROOM_IDLE_TTL = float(os.environ.get("ROOM_IDLE_TTL", "1800"))
+FINISHED_ROOM_TTL = float(os.environ.get("FINISHED_ROOM_TTL", "300"))
+# JSONL-файл, куди дописуються журнали завершених ігор для replay.py (порожній - не записувати)
+GAME_LOG = os.environ.get("GAME_LOG", "")
+# Пауза перед дією бота, секунди: щоб люди встигали стежити за грою
+BOT_DELAY = float(os.environ.get("BOT_DELAY", "1"))
+# Публічний порт віддає і сторінки WebApp, і WebSocket (0 - лише WebSocket) та скільки секунд тримати keep-alive
+HTTP_FRONTEND = os.environ.get("HTTP_FRONTEND", "1") == "1"
+HTTP_KEEPALIVE = float(os.environ.get("HTTP_KEEPALIVE", "75"))
+# Скільки секунд воркер шардованого режиму має на збереження стану після SIGTERM
+WORKER_STOP_TIMEOUT = float(os.environ.get("WORKER_STOP_TIMEOUT", "10"))
+
+
+class FanoutStats:
+    """Статистика затримки розсилки (fan-out) для однієї кімнати.
+
+    Рахує кожен кадр кімнати від постановки в чергу Connection до запису в сокет;
+    невдача - кадр, запис якого перевищив SEND_TIMEOUT.
+    """
+
     def __init__(self):
-        ranks = ['6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
-        suits = ['♥', '♦', '♣', '♠']
-        self.cards = [f"{rank}{suit}" for rank in ranks for suit in suits]
-        random.shuffle(self.cards)
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+        self.failures = 0
+
+    def record(self, elapsed, failed):
+        self.count += 1
+        self.total += elapsed
+        self.last = elapsed
+        self.max = max(self.max, elapsed)
+        self.failures += failed
+
+    def as_dict(self):
+        avg = self.total / self.count if self.count else 0.0
+        return {
+            'count': self.count,
+            'avg_ms': round(avg * 1000, 3),
+            'last_ms': round(self.last * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+            'failures': self.failures,
+        }
+
+
+class TokenBucket:
+    """Обмежувач швидкості: rate токенів за секунду, не більше burst у запасі."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Connection:
+    """З'єднання клієнта з обмеженою вихідною чергою та власною задачею-писарем.
+
+    Connection.send лише ставить кадр у чергу, тож повільний клієнт не затримує
+    кімнату. Якщо черга переповнюється, накопичені кадри відкидаються, а кімната
+    (через on_overflow) повторює події після останнього записаного кадру і шле
+    один свіжий знімок стану. Клієнта, який довше за EVICT_AFTER не встигає
+    читати, відключаємо.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.name = None
+        self.on_overflow = None
+        # Статистика розсилки кімнати, до якої приєднався клієнт
+        self.fanout_stats = None
+        # Кадри (payload, час постановки в чергу)
+        self.queue = deque()
+        self.queued_chars = 0
+        self.over_since = None
+        # Номер останньої події, яку клієнт точно отримав, і чи чекаємо на повтор після переповнення
+        self.written_seq = 0
+        self.replaying = False
+        self.closed = False
+        self._close_after = None
+        self._wakeup = asyncio.Event()
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def send(self, payload):
+        if self.closed:
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        if self.replaying:
+            # Ці події вже в буфері кімнати і прийдуть разом із повтором
+            metrics.dropped_frames.inc()
+            return
+        self.queue.append((payload, time.perf_counter()))
+        self.queued_chars += len(payload)
+        if len(self.queue) > OUTBOX_HIGH_WATER or self.queued_chars > OUTBOX_MAX_CHARS:
+            self._overflow()
+        self._wakeup.set()
+
+    def _overflow(self):
+        now = time.monotonic()
+        if self.over_since is None:
+            self.over_since = now
+        elif now - self.over_since > EVICT_AFTER:
+            logger.warning("Evicting %s: outbox over high-water for %.0fs.", self.name, now - self.over_since)
+            metrics.evictions.inc()
+            self.close(1013, "Client too slow")
+            return
+        # Відкидаємо чергу: кімната повторить пропущені події з буфера і надішле свіжий знімок
+        metrics.dropped_frames.inc(amount=len(self.queue))
+        self.queue.clear()
+        self.queued_chars = 0
+        if self.on_overflow is not None:
+            self.replaying = True
+            self.on_overflow(self.written_seq)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self.queue:
+                    if self._close_after is not None:
+                        await self.websocket.close(*self._close_after)
+                        return
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                payload, queued_at = self.queue.popleft()
+                self.queued_chars -= len(payload)
+                # Кадр, переданий сокету, дійде до клієнта, якщо з'єднання не розірветься
+                seq = codec.batch_seq(payload)
+                if seq is not None:
+                    self.written_seq = seq
+                started = time.perf_counter()
+                timed_out = False
+                try:
+                    await asyncio.wait_for(self.websocket.send(payload), SEND_TIMEOUT)
+                    metrics.frames_out.inc()
+                    metrics.bytes_sent.inc(amount=len(payload.encode('utf-8')))
+                    # Клієнт знову читає: лічильник часу над межею скидається
+                    if len(self.queue) <= OUTBOX_HIGH_WATER // 2:
+                        self.over_since = None
+                except asyncio.TimeoutError:
+                    logger.warning("Send to %s timed out after %ss.", self.name, SEND_TIMEOUT)
+                    metrics.slow_clients.inc()
+                    metrics.send_failures.inc('timeout')
+                    timed_out = True
+                finished = time.perf_counter()
+                metrics.send_seconds.observe(finished - started)
+                # Затримка розсилки включає час у черзі: саме її відчуває гравець
+                metrics.fanout_seconds.observe(finished - queued_at)
+                if self.fanout_stats is not None:
+                    self.fanout_stats.record(finished - queued_at, timed_out)
+        except websockets.exceptions.ConnectionClosed:
+            metrics.send_failures.inc('closed')
+        finally:
+            self.closed = True
+            self.queue.clear()
+            self.queued_chars = 0
+
+    def close(self, code=1000, reason="", drain=False):
+        """Закриває з'єднання; з drain=True спершу дописує кадри, що вже стоять у черзі."""
+        self.closed = True
+        if drain and not self._writer.done():
+            self._close_after = (code, reason)
+            self._wakeup.set()
+            return
+        self._writer.cancel()
+        asyncio.ensure_future(self.websocket.close(code, reason))
+
+
+def diff_state(old, new, path=''):
+    """Будує список операцій у стилі JSON Patch, що перетворюють old на new."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key, value in new.items():
+            key_path = f"{path}/{key}"
+            if key not in old:
+                ops.append({'op': 'add', 'path': key_path, 'value': value})
+            elif old[key] != value:
+                ops.extend(diff_state(old[key], value, key_path))
+        for key in old.keys() - new.keys():
+            ops.append({'op': 'remove', 'path': f"{path}/{key}"})
+        return ops
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        ops = []
+        for i, (a, b) in enumerate(zip(old, new)):
+            if a != b:
+                ops.extend(diff_state(a, b, f"{path}/{i}"))
+        return ops
+    return [{'op': 'replace', 'path': path, 'value': new}]
+
+RANKS = ('6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A')
+SUITS = ('♥', '♦', '♣', '♠')
+RANK_INDEX = {rank: i for i, rank in enumerate(RANKS)}
+SUIT_INDEX = {suit: i for i, suit in enumerate(SUITS)}
+# Карта - ціле число rank * 4 + suit; рядок на кшталт "10♥" потрібен лише на межі з клієнтом
+CARD_NAMES = tuple(f"{rank}{suit}" for rank in RANKS for suit in SUITS)
+CARD_IDS = tuple(range(len(CARD_NAMES)))
+FULL_SET = 0b1111
+_NIBBLE_COUNT = tuple(bin(i).count('1') for i in range(16))
+
+
+def card_rank(card):
+    return card >> 2
+
+
+def suits_of(suit_mask):
+    """Множина назв мастей для 4-бітової маски."""
+    return {suit for i, suit in enumerate(SUITS) if suit_mask >> i & 1}
+
+
+class Hand:
+    """Рука гравця як 36-бітова маска: по 4 біти мастей на кожен ранг.
+
+    Кількість карт рангу, перевірка мастей, збір скриньки та передача
+    карт між руками - це кілька бітових операцій.
+    """
+
+    __slots__ = ('mask', 'size')
+
+    def __init__(self, cards=()):
+        self.mask = 0
+        self.size = 0
+        for card in cards:
+            self.add(card)
+
+    @classmethod
+    def from_mask(cls, mask):
+        hand = cls()
+        hand.mask = mask
+        hand.size = bin(mask).count('1')
+        return hand
+
+    def add(self, card):
+        bit = 1 << card
+        if not self.mask & bit:
+            self.mask |= bit
+            self.size += 1
+
+    def suit_mask(self, rank):
+        return (self.mask >> (rank << 2)) & FULL_SET
+
+    def rank_count(self, rank):
+        return _NIBBLE_COUNT[self.suit_mask(rank)]
+
+    def take_rank(self, rank):
+        """Забирає з руки всі карти рангу і повертає їхню маску мастей."""
+        suits = self.suit_mask(rank)
+        self.mask &= ~(FULL_SET << (rank << 2))
+        self.size -= _NIBBLE_COUNT[suits]
+        return suits
+
+    def add_rank(self, rank, suits):
+        before = self.suit_mask(rank)
+        self.mask |= suits << (rank << 2)
+        self.size += _NIBBLE_COUNT[before | suits] - _NIBBLE_COUNT[before]
+
+    def to_strings(self):
+        return [CARD_NAMES[card] for card in self]
+
+    def __iter__(self):
+        mask = self.mask
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+
+class Deck:
+    """Перетасована колода; взяття карти лише зсуває позицію в списку."""
+
+    def __init__(self, rng=None):
+        self.rng = rng if rng is not None else random.Random()
+        self.cards = list(CARD_IDS)
+        self.rng.shuffle(self.cards)
+        self.position = 0
 
     def draw(self, count=1):
-        drawn_cards = [self.cards.pop(0) for _ in range(min(count, len(self.cards)))]
+        drawn_cards = self.cards[self.position:self.position + count]
+        self.position += len(drawn_cards)
         return drawn_cards
 
+    def deal(self, n_players, n_cards):
+        """Роздає по n_cards карт n_players гравцям по колу, як при роздачі по одній."""
+        dealt = self.draw(n_players * n_cards)
+        return [dealt[i::n_players] for i in range(n_players)]
+
     def is_empty(self):
-        return len(self.cards) == 0
+        return self.position >= len(self.cards)
+
+    def __len__(self):
+        return len(self.cards) - self.position
+
+# Найбільша кількість гравців у кімнаті
+MAX_PLAYERS = 6
 
 class Player:
+    is_bot = False
+
     def __init__(self, name, websocket):
         self.name = name
         self.websocket = websocket
-        self.hand = []
+        self.hand = Hand()
         self.collected_sets = []
+        # Версія стану, яку має клієнт, і маска його руки на момент цієї версії (None - потрібен повний знімок)
+        self.state_version = None
+        self.last_hand = None
+        # Номер версії з останнього кадру, який клієнт отримав: порожні дельти не шлються, тож він може відставати
+        self.sent_version = None
+        # Токен сесії для повернення після розриву з'єднання та час розриву
+        self.session = secrets.token_urlsafe(16)
+        self.disconnected_at = None
+
+
+class CardTracker:
+    """Що бот знає про чужі руки з публічних подій журналу гри.
+
+    holds[гравець][ранг] - маска мастей, які точно є в гравця (бачили передачу);
+    has[гравець][ранг] - чи є в нього ранг (з відповідей і запитів);
+    counts, wrong_counts, wrong_suits - вгадана кількість і вже відкинуті здогади.
+    Коли рука гравця змінюється непомітно (взяв карту з колоди), усе, крім
+    точно відомих карт, про нього забувається.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.journal = None
+        self.seen = 0
+        self.reset()
+
+    def reset(self):
+        self.holds = defaultdict(dict)
+        self.has = defaultdict(dict)
+        self.counts = defaultdict(dict)
+        self.wrong_counts = defaultdict(lambda: defaultdict(set))
+        self.wrong_suits = defaultdict(lambda: defaultdict(set))
+        self.collected = set()
+        self.ask = None
+        # Здогад про кількість, результат якого видно з наступної події
+        self.pending_count = None
+        self.last_count = 0
+
+    def observe(self, journal):
+        """Дочитує нові події журналу; новий журнал (нова гра) скидає знання."""
+        if journal is not self.journal:
+            self.journal = journal
+            self.seen = 0
+            self.reset()
+        for event in journal[self.seen:]:
+            self._see(event)
+        self.seen = len(journal)
+
+    def _forget(self, name, rank=None):
+        for known in (self.counts, self.wrong_counts, self.wrong_suits):
+            if rank is None:
+                known.pop(name, None)
+            elif name in known:
+                known[name].pop(rank, None)
+
+    def _see(self, event):
+        kind, name = event[0], event[1]
+        if self.pending_count is not None and kind not in ('guess_suits', 'leave'):
+            # Після вгаданої кількості йде guess_suits, інакше - взяття карти або зміна ходу
+            target, rank, count = self.pending_count
+            self.wrong_counts[target][rank].add(count)
+            self.pending_count = None
+
+        if kind in ('deal', 'draw'):
+            if name != self.name:
+                self.has[name] = {rank: True for rank, has in self.has[name].items() if has}
+                self._forget(name)
+        elif kind == 'ask':
+            self.ask = event[1:]
+            # Зазвичай питають про ранг, який уже є в руці
+            self.has[name][event[3]] = True
+        elif kind == 'response' and self.ask is not None:
+            rank = self.ask[2]
+            self.has[name][rank] = event[2]
+            if not event[2]:
+                self.holds[name].pop(rank, None)
+                self.counts[name][rank] = 0
+        elif kind == 'guess_count' and self.ask is not None:
+            self.pending_count = (self.ask[1], self.ask[2], event[2])
+            self.last_count = event[2]
+        elif kind == 'guess_suits' and self.ask is not None:
+            asker, target, rank = self.ask
+            self.pending_count = None
+            if event[3]:
+                self.holds[asker][rank] = self.holds[asker].get(rank, 0) | event[3]
+                self.holds[target].pop(rank, None)
+                self.has[asker][rank] = True
+                self.has[target][rank] = False
+                self._forget(asker, rank)
+                self._forget(target, rank)
+                self.counts[target][rank] = 0
+            else:
+                self.counts[target][rank] = self.last_count
+                self.wrong_suits[target][rank].add(event[2])
+        elif kind == 'set_collected':
+            rank = event[2]
+            self.collected.add(rank)
+            for known in (*self.holds.values(), *self.has.values()):
+                known.pop(rank, None)
+            for player in list(self.counts):
+                self._forget(player, rank)
+        elif kind == 'turn_change':
+            self.ask = None
+        elif kind == 'leave':
+            for known in (self.holds, self.has):
+                known.pop(name, None)
+            self._forget(name)
+
+    def _held_by_others(self, rank, target):
+        mask = 0
+        # Свою руку бот бачить сам, тож рахуємо лише суперників, крім target
+        for name, known in self.holds.items():
+            if name not in (target, self.name):
+                mask |= known.get(rank, 0)
+        return mask
+
+    def choose_ask(self, opponents, hand, rng):
+        """Повертає (у кого питати, ранг) або (None, None), якщо питати нікого."""
+        if not opponents:
+            return None, None
+        my_ranks = sorted({card_rank(card) for card in hand}, key=lambda rank: -hand.rank_count(rank))
+        # Спершу ранг, який у мене є і точно є в суперника
+        for rank in my_ranks:
+            for name in opponents:
+                if self.holds[name].get(rank) or self.has[name].get(rank):
+                    return name, rank
+        live_ranks = [rank for rank in range(len(RANKS)) if rank not in self.collected] or list(range(len(RANKS)))
+        rank = my_ranks[0] if my_ranks else rng.choice(live_ranks)
+        possible = [name for name in opponents if self.has[name].get(rank) is not False] or opponents
+        return rng.choice(possible), rank
+
+    def guess_count(self, target, rank, hand):
+        exact = self.counts[target].get(rank)
+        if exact:
+            return exact
+        known = _NIBBLE_COUNT[self.holds[target].get(rank, 0)]
+        free = len(SUITS) - hand.rank_count(rank) - _NIBBLE_COUNT[self._held_by_others(rank, target)]
+        wrong = self.wrong_counts[target][rank]
+        # Одна карта рангу в суперника найімовірніша, тож перебираємо від меншої
+        for count in range(max(known, 1), max(free, 1) + 1):
+            if count not in wrong:
+                return count
+        return max(known, 1)
+
+    def guess_suits(self, target, rank, hand, count, rng):
+        sure = self.holds[target].get(rank, 0)
+        excluded = hand.suit_mask(rank) | self._held_by_others(rank, target)
+        free = [i for i in range(len(SUITS)) if not excluded >> i & 1]
+        wrong = self.wrong_suits[target][rank]
+        options = []
+        for combination in itertools.combinations(free, min(count, len(free))):
+            mask = sum(1 << i for i in combination)
+            if mask & sure == sure and mask not in wrong:
+                options.append(mask)
+        if not options:
+            return [SUITS[i] for i in rng.sample(free, min(count, len(free)))]
+        mask = rng.choice(options)
+        return [suit for i, suit in enumerate(SUITS) if mask >> i & 1]
+
+
+class BotPlayer(Player):
+    """Гравець без з'єднання, яким керує сервер.
+
+    Бот бачить лише свою руку та публічні події журналу і ходить через ті самі
+    handle_* методи Game, що й люди.
+    """
+
+    is_bot = True
+
+    def __init__(self, name, rng=None):
+        super().__init__(name, None)
+        self.rng = rng if rng is not None else random.Random()
+        self.tracker = CardTracker(name)
+
+    def act(self, game):
+        """Робить дію, на яку гра чекає від бота; повертає, чи вдалося."""
+        tracker = self.tracker
+        tracker.observe(game.journal)
+        if game.phase == 'ask':
+            opponents = [name for name in game.players if name != self.name]
+            target, rank = tracker.choose_ask(opponents, self.hand, self.rng)
+            if target is None:
+                return False
+            game.handle_ask_card(self.name, target, RANKS[rank])
+        elif game.phase == 'response':
+            has_rank = self.hand.rank_count(RANK_INDEX[game.asked_rank]) > 0
+            game.handle_ask_response(self.name, 'yes' if has_rank else 'no')
+        elif game.phase == 'guess_count':
+            rank = RANK_INDEX[game.asked_rank]
+            game.handle_guess_count(self.name, tracker.guess_count(game.target_player, rank, self.hand))
+        elif game.phase == 'guess_suits':
+            rank = RANK_INDEX[game.asked_rank]
+            suits = tracker.guess_suits(game.target_player, rank, self.hand, tracker.last_count, self.rng)
+            game.handle_guess_suits(self.name, suits)
+        return True
+
 
 class Game:
-    def __init__(self):
+    def __init__(self, seed=None, headless=False):
         self.players = {}
-        self.deck = Deck()
+        # Без гравців-людей (симуляція): повідомлення не формуються зовсім
+        self.headless = headless
+        # Кожна кімната має власний генератор; з тим самим seed роздачі повторюються
+        self.seed = seed if seed is not None else random.randrange(2 ** 63)
+        self.rng = random.Random(self.seed)
+        self.deck = Deck(self.rng)
         self.game_started = False
+        self.finished = False
         self.current_turn_index = 0
         self.asking_player = None
         self.target_player = None
         self.asked_rank = None
+        # Чого гра чекає: 'ask' від того, хто ходить, 'response' від того, кого спитали, далі 'guess_count' і 'guess_suits'
+        self.phase = 'ask'
         self.room_admin = None
+        self.fanout_stats = FanoutStats()
+        # Вихідна черга кімнати: події, накопичені під час обробки одного вхідного повідомлення
+        self._outbox = []
+        self._state_dirty = False
+        # Кільцевий буфер останніх подій (seq, отримувач, payload) для повторної відправки після розриву
+        self.event_seq = 0
+        self._history = deque(maxlen=REPLAY_BUFFER)
+        # Монотонна версія публічного стану кімнати та сам стан цієї версії
+        self.state_version = 0
+        self._last_state = None
+        # Журнал поточної гри: типізовані події-кортежі, з яких replay.py відтворює стан на будь-якому кроці
+        self.journal = []
 
-    async def add_player(self, name, websocket):
-        if not self.game_started and len(self.players) < 6:
+    def add_player(self, name, websocket, bot=False):
+        if not self.game_started and len(self.players) < MAX_PLAYERS:
             if name in self.players:
                 return False, "Гравець з таким ім'ям вже є в кімнаті."
-            player = Player(name, websocket)
+            player = BotPlayer(name, random.Random(self.rng.random())) if bot else Player(name, websocket)
             self.players[name] = player
             if self.room_admin is None:
                 self.room_admin = name
@@ -56,93 +603,165 @@ class Game:
         else:
             return False, "Кімната повна."
 
+    def add_bot(self):
+        """Садить бота на вільне місце; результат як у add_player."""
+        number = 1
+        while f"Бот {number}" in self.players:
+            number += 1
+        return self.add_player(f"Бот {number}", None, bot=True)
+
+    def replace_with_bot(self, name):
+        """Віддає місце гравця боту з тією самою рукою і скриньками - гра не зупиняється."""
+        player = self.players[name]
+        bot = BotPlayer(name, random.Random(self.rng.random()))
+        bot.hand = player.hand
+        bot.collected_sets = player.collected_sets
+        self.players[name] = bot
+        if self.room_admin == name:
+            self.room_admin = next((p.name for p in self.players.values() if not p.is_bot), name)
+
+    def waiting_for_bot(self):
+        """Бот, від якого гра зараз чекає дії, або None."""
+        if not self.game_started:
+            return None
+        player = self.players.get(self.target_player if self.phase == 'response' else self.asking_player)
+        return player if player is not None and player.is_bot else None
+
+    def play_bot(self):
+        """Виконує одну дію бота, якщо гра на неї чекає; повертає, чи щось зроблено."""
+        bot = self.waiting_for_bot()
+        return bot is not None and bot.act(self)
+
+    def disconnect_player(self, name, websocket):
+        """Звільняє з'єднання гравця, але залишає його місце до повернення або завершення RESUME_GRACE."""
+        player = self.players.get(name)
+        if player is None or player.websocket is not websocket:
+            return None
+        player.websocket = None
+        player.disconnected_at = time.monotonic()
+        return player.disconnected_at
+
+    def resume_player(self, name, session, websocket, last_seq=0):
+        """Прив'язує нове з'єднання до наявного гравця та повторює пропущені ним події."""
+        player = self.players.get(name)
+        if player is None or not secrets.compare_digest(player.session, str(session)):
+            return False, "Сесію не знайдено. Приєднайтеся знову."
+        if isinstance(player.websocket, Connection) and player.websocket is not websocket:
+            # Старе з'єднання ще живе (клієнт перепідключився раніше, ніж сервер помітив розрив) - місцем керує лише нове
+            player.websocket.close(4000, "Session resumed elsewhere")
+        player.websocket = websocket
+        player.disconnected_at = None
+        missed = self._missed_events(name, last_seq)
+        self.send_to(name, {'type': 'joined_room', 'session': player.session, 'resumed': True})
+        self._outbox.extend((name, payload) for payload in missed)
+        self.request_snapshot(name)
+        return True, f"Гравець {name} повернувся."
+
+    def replay_missed(self, name, last_seq):
+        """Повторює гравцю події після last_seq і ставить у чергу повний знімок стану."""
+        self._outbox.extend((name, payload) for payload in self._missed_events(name, last_seq))
+        self.request_snapshot(name)
+
+    def _missed_events(self, name, last_seq):
+        return [payload for seq, recipient, payload in self._history
+                if seq > last_seq and recipient in (None, name)]
+
     def remove_player(self, name):
         if name in self.players:
+            if self.game_started:
+                self.journal.append(('leave', name))
             del self.players[name]
             if name == self.room_admin:
-                self.room_admin = next(iter(self.players), None)
+                # Адміном стає гравець на зв'язку: бот чи відключений гравець не зміг би почати гру
+                candidates = sorted(self.players.values(), key=lambda p: (p.is_bot, p.websocket is None))
+                self.room_admin = candidates[0].name if candidates else None
 
-    async def start_game(self):
+    @metrics.timed
+    def start_game(self, deck_seed=None):
+        """Починає гру; deck_seed задає колоду явно (для повтору з журналу)."""
         if len(self.players) >= 2 and not self.game_started:
             self.game_started = True
+            self.finished = False
+            self.phase = 'ask'
+            # Кожна гра має власний seed колоди, тож її можна відтворити з журналу окремо від кімнати
+            if deck_seed is None:
+                deck_seed = self.rng.randrange(2 ** 63)
+            self.journal = [('seed', deck_seed, list(self.players))]
 
             # Очищуємо стан гравців та колоду для нової гри
             for p in self.players.values():
-                p.hand = []
+                p.hand = Hand()
                 p.is_turn = False
                 p.collected_sets = []
             
-            self.deck = Deck()
-            await self.deal_initial_cards()
+            self.deck = Deck(random.Random(deck_seed))
+            self.deal_initial_cards()
             player_names = list(self.players.keys())
             self.current_turn_index = 0
             self.asking_player = player_names[self.current_turn_index]
             self.players[self.asking_player].is_turn = True
-            await self.notify_all("Гра розпочалась! Перший хід за " + self.asking_player)
+            self.notify_all("Гра розпочалась! Перший хід за " + self.asking_player)
             
             # Перевіряємо, чи має перший гравець карти, щоб розпочати хід
-            await self.check_and_deal_if_needed(self.asking_player)
+            self.check_and_deal_if_needed(self.asking_player)
             
-            await self.notify_all_state()
+            self.notify_all_state()
             return True
         return False
     
-    async def deal_initial_cards(self):
+    def deal_initial_cards(self):
         num_players = len(self.players)
         cards_to_deal = 4 #5 if num_players <= 3 else 4
         
-        for _ in range(cards_to_deal):
-            for player_name in self.players:
-                card = self.deck.draw()[0]
-                self.players[player_name].hand.append(card)
+        hands = self.deck.deal(num_players, cards_to_deal)
+        for player, cards in zip(self.players.values(), hands):
+            player.hand = Hand(cards)
+            self.journal.append(('deal', player.name, player.hand.mask))
         
         for player_name in self.players:
             player = self.players[player_name]
             if self.check_for_sets(player):
-                await self.notify_all(f"Гравець {player.name} зібрав скриньку під час роздачі!")
+                self.notify_all(f"Гравець {player.name} зібрав скриньку під час роздачі!")
 
-    def check_for_sets(self, player):
+    def check_for_sets(self, player, ranks=range(len(RANKS))):
+        """Забирає з руки повні скриньки серед ranks і повертає список їхніх рангів."""
         hand = player.hand
-        ranks = {}
-        for card in hand:
-            rank = card[:-1]
-            ranks[rank] = ranks.get(rank, 0) + 1
-        
         newly_collected_ranks = []
-        for rank, count in ranks.items():
-            if count == 4:
-                newly_collected_ranks.append(rank)
-                player.collected_sets.append(rank)
-        
-        if newly_collected_ranks:
-            player.hand = [card for card in hand if card[:-1] not in newly_collected_ranks]
-            return True
-        return False
+        for rank in ranks:
+            if hand.suit_mask(rank) == FULL_SET:
+                hand.take_rank(rank)
+                self.journal.append(('set_collected', player.name, rank))
+                newly_collected_ranks.append(RANKS[rank])
+                player.collected_sets.append(RANKS[rank])
+        return newly_collected_ranks
 
-    async def check_and_deal_if_needed(self, player_name):
+    def check_and_deal_if_needed(self, player_name):
         """Перевіряє, чи порожня рука гравця, і якщо так, видає йому карту з колоди."""
         player = self.players.get(player_name)
         if player and not player.hand and not self.deck.is_empty():
             new_card = self.deck.draw()[0]
-            player.hand.append(new_card)
-            await self.notify_all(f"У гравця {player_name} порожня рука. Автоматично взято карту з колоди.")
+            player.hand.add(new_card)
+            self.journal.append(('draw', player_name, new_card))
+            self.notify_all(f"У гравця {player_name} порожня рука. Автоматично взято карту з колоди.")
             return True
         return False
 
-    async def next_turn(self):
+    def next_turn(self):
         player_names = list(self.players.keys())
         self.current_turn_index = (self.current_turn_index + 1) % len(player_names)
         self.asking_player = player_names[self.current_turn_index]
         self.target_player = None
         self.asked_rank = None
-        await self.notify_all(f"Хід переходить до гравця {self.asking_player}.")
+        self.phase = 'ask'
+        self.journal.append(('turn_change', self.asking_player))
+        self.notify_all(f"Хід переходить до гравця {self.asking_player}.")
         
         # Перевіряємо, чи має наступний гравець карти, щоб розпочати хід
-        await self.check_and_deal_if_needed(self.asking_player)
+        self.check_and_deal_if_needed(self.asking_player)
         
-        await self.notify_all_state()
+        self.notify_all_state()
 
-    async def check_end_game(self):
+    def check_end_game(self):
         total_collected = sum(len(p.collected_sets) for p in self.players.values())
         if total_collected == 9:
             max_sets = 0
@@ -167,24 +786,35 @@ class Game:
                 reverse=True
             )
 
+            # Повідомлення відрізняється лише полем isAdmin, тому серіалізуємо два варіанти
+            game_over = {
+                'type': 'game_over',
+                'message': winner_message,
+                'winner': ', '.join(winners),
+                'results': player_results # Додаємо результати всіх гравців
+            }
+            payloads = {
+                is_admin: codec.dumps({**game_over, 'isAdmin': is_admin})
+                for is_admin in (True, False)
+            }
             for p in self.players.values():
-                is_admin = p.name == self.room_admin
-                await p.websocket.send(json.dumps({
-                    'type': 'game_over',
-                    'message': winner_message,
-                    'winner': ', '.join(winners),
-                    'isAdmin': is_admin,
-                    'results': player_results # Додаємо результати всіх гравців
-                }))
+                self._emit(p.name, payloads[p.name == self.room_admin], 'game_over')
         
             self.game_started = False
+            self.finished = True
             return True
         return False
     
-    async def handle_ask_card(self, asking_player_name, target_player_name, card_rank):
+    @metrics.timed
+    def handle_ask_card(self, asking_player_name, target_player_name, card_rank):
+        if card_rank not in RANK_INDEX:
+            self.send_to(asking_player_name, {'type': 'error', 'message': "Невідоме значення карти."})
+            return
         self.asking_player = asking_player_name
         self.target_player = target_player_name
         self.asked_rank = card_rank
+        self.phase = 'response'
+        self.journal.append(('ask', asking_player_name, target_player_name, RANK_INDEX[card_rank]))
         
         target_player = self.players.get(target_player_name)
         if target_player:
@@ -193,243 +823,1146 @@ class Game:
                 'asking_player': asking_player_name,
                 'card_rank': card_rank
             }
-            await target_player.websocket.send(json.dumps(message))
+            self.send_to(target_player_name, message)
 
-    async def handle_ask_response(self, target_player_name, response):
+    @metrics.timed
+    def handle_ask_response(self, target_player_name, response):
         asking_player = self.players.get(self.asking_player)
         target_player = self.players.get(target_player_name)
-        
-        target_cards_to_transfer = [card for card in target_player.hand if card[:-1] == self.asked_rank]
+        self.journal.append(('response', target_player_name, response == 'yes'))
         
         #додано для доповнення журналу
-        await self.notify_all(f"Гравець {self.asking_player} запитує у {target_player.name}, чи має той карти значення {self.asked_rank}?")
+        self.notify_all(f"Гравець {self.asking_player} запитує у {target_player.name}, чи має той карти значення {self.asked_rank}?")
         
         if response == 'yes':
-            await self.notify_all(f"Гравець {target_player.name} відповідає 'Так'.")
-            await self.notify_all(f"Гравець {self.asking_player} має вгадати кількість карт  {self.asked_rank}.")
-            await self.players.get(self.asking_player).websocket.send(json.dumps({
+            self.phase = 'guess_count'
+            self.notify_all(f"Гравець {target_player.name} відповідає 'Так'.")
+            self.notify_all(f"Гравець {self.asking_player} має вгадати кількість карт  {self.asked_rank}.")
+            self.send_to(self.asking_player, {
                 'type': 'guess_count_needed',
                 'target_player': target_player_name,
                 'card_rank': self.asked_rank
-            }))
+            })
         
         else:
-            await self.notify_all(f"Гравець {target_player.name} відповідає 'Ні'. {asking_player.name} іде на рибалку.")
-            await self.draw_card_and_check_sets(asking_player)#, self.asked_rank)
+            self.notify_all(f"Гравець {target_player.name} відповідає 'Ні'. {asking_player.name} іде на рибалку.")
+            self.draw_card_and_check_sets(asking_player)#, self.asked_rank)
         
-        await self.check_end_game()
-        await self.notify_all_state()
+        self.check_end_game()
+        self.notify_all_state()
 
-    async def draw_card_and_check_sets(self, player):
+    def draw_card_and_check_sets(self, player):
         if not self.deck.is_empty():
             new_card = self.deck.draw()[0]
-            player.hand.append(new_card)
-            new_card_rank = new_card[:-1] # Витягуємо ранг з нової карти (наприклад, 'Q' з 'Q♦')
+            player.hand.add(new_card)
+            self.journal.append(('draw', player.name, new_card))
+            new_card_rank = RANKS[card_rank(new_card)] # Ранг нової карти (наприклад, 'Q' для 'Q♦')
 
-            await self.notify_all(f"Гравець {player.name} бере карту з колоди.")
+            self.notify_all(f"Гравець {player.name} бере карту з колоди.")
 
-            # Перевірка на скриньки
-            sets_collected = self.check_for_sets(player)
+            # Перевірка на скриньки - повною може стати лише скринька рангу нової карти
+            sets_collected = self.check_for_sets(player, (card_rank(new_card),))
             if sets_collected:
-                await self.notify_all(f"Гравець {player.name} зібрав скриньку {new_card_rank}!")
+                self.notify_all(f"Гравець {player.name} зібрав скриньку {new_card_rank}!")
 
             # Перевірка на порожню руку після збору скриньки
             if not player.hand and not self.deck.is_empty():
-                await self.notify_all(f"У гравця {player.name} порожня рука після збору скриньки. Автоматично бере ще одну карту.")
+                self.notify_all(f"У гравця {player.name} порожня рука після збору скриньки. Автоматично бере ще одну карту.")
                 new_card_after_set = self.deck.draw()[0]
-                player.hand.append(new_card_after_set)
+                player.hand.add(new_card_after_set)
+                self.journal.append(('draw', player.name, new_card_after_set))
         
             # Передача ходу лише після всіх перевірок
-        await self.next_turn()
+        self.next_turn()
 
-    async def handle_guess_count(self, guessing_player_name, count):
+    @metrics.timed
+    def handle_guess_count(self, guessing_player_name, count):
         asking_player = self.players.get(guessing_player_name)
         target_player = self.players.get(self.target_player)
 
         # Визначаємо правильну кількість карт у суперника
-        correct_count = sum(1 for card in target_player.hand if card[:-1] == self.asked_rank)
+        correct_count = target_player.hand.rank_count(RANK_INDEX[self.asked_rank])
+        self.journal.append(('guess_count', guessing_player_name, count))
     
         # Додаємо запис в історію гри
-        await self.notify_all(f"Гравець {asking_player.name} вгадує, що у гравця {target_player.name} {count} карт рангу {self.asked_rank}.")
+        self.notify_all(f"Гравець {asking_player.name} вгадує, що у гравця {target_player.name} {count} карт рангу {self.asked_rank}.")
 
         if count == correct_count:
             # Успішне вгадування кількості
-            await self.notify_all(f"Гравець {asking_player.name} вгадав кількість карт: {count}. Він продовжує вгадувати масті.")
+            self.notify_all(f"Гравець {asking_player.name} вгадав кількість карт: {count}. Він продовжує вгадувати масті.")
 
             # Відправляємо клієнту повідомлення з даними, необхідними для відображення форми
-            await asking_player.websocket.send(json.dumps({
+            self.send_to(asking_player.name, {
                 'type': 'guess_suits_needed',
                 'target_player': self.target_player,
                 'card_rank': self.asked_rank,
                 'correct_count': correct_count
-            }))
+            })
         
             # Встановлюємо наступний крок
-            self.current_step = 'guess_suits'
+            self.phase = 'guess_suits'
 
         else:
             # Невдале вгадування
-            await self.notify_all(f"Гравець {asking_player.name} не вгадав кількість. Він бере карту з колоди.")
+            self.notify_all(f"Гравець {asking_player.name} не вгадав кількість. Він бере карту з колоди.")
         
             # Далі продовжуємо гру, як і раніше
-            await self.draw_card_and_check_sets(asking_player)
+            self.draw_card_and_check_sets(asking_player)
 
-        await self.check_end_game()
-        await self.notify_all_state()
+        self.check_end_game()
+        self.notify_all_state()
 
-    async def handle_guess_suits(self, asking_player_name, suits):
+    @metrics.timed
+    def handle_guess_suits(self, asking_player_name, suits):
         asking_player = self.players.get(asking_player_name)
         target_player = self.players.get(self.target_player)
         
-        target_cards_to_transfer = [card for card in target_player.hand if card[:-1] == self.asked_rank]
-        target_suits = [card[-1] for card in target_cards_to_transfer]
-        
-        guessed_correctly = set(suits) == set(target_suits)
+        rank = RANK_INDEX[self.asked_rank]
+        target_suits = target_player.hand.suit_mask(rank)
+
+        # Невідома масть дає біт поза маскою, тож такий здогад ніколи не збігається
+        guessed_suits = 0
+        for suit in suits:
+            guessed_suits |= 1 << SUIT_INDEX.get(suit, len(SUITS))
+        guessed_correctly = guessed_suits == target_suits
+        # Остання величина - маска переданих карт (0, якщо не вгадав)
+        self.journal.append(('guess_suits', asking_player_name, guessed_suits, target_suits if guessed_correctly else 0))
 
         if guessed_correctly:
-            for card in target_cards_to_transfer:
-                target_player.hand.remove(card)
-                asking_player.hand.append(card)
+            asking_player.hand.add_rank(rank, target_player.hand.take_rank(rank))
             #тут додано стосовно set(target_suits)
-            await self.notify_all(f"Гравець {asking_player.name} вгадав масті {set(target_suits)} і отримує карти від гравця {target_player.name}.")
-
-            # перевірка, чи зібрана скринька
-            self.check_for_sets(asking_player)
+            self.notify_all(f"Гравець {asking_player.name} вгадав масті {suits_of(target_suits)} і отримує карти від гравця {target_player.name}.")
 
-            # Перевірка на зібрану скриньку після передачі карт
-            # Якщо кількість карт у руці зменшилась після check_for_sets,
-            # значить, скринька була зібрана.
-            # Ми припускаємо, що це саме та скринька, ранг якої вгадував гравець.
-            # Це найбезпечніший спосіб, враховуючи поточну логіку.
-            if len(asking_player.hand) % 4 == 0:
-                await self.notify_all(f"Гравець {asking_player.name} зібрав скриньку {self.asked_rank}!")
+            # Перевірка на зібрану скриньку після передачі карт: повною може стати лише скринька вгаданого рангу
+            if self.check_for_sets(asking_player, (rank,)):
+                self.notify_all(f"Гравець {asking_player.name} зібрав скриньку {self.asked_rank}!")
 
 
             # Якщо у гравця, що вгадав, не залишилось карт, він бере нову з колоди
-            await self.check_and_deal_if_needed(asking_player.name)
+            self.check_and_deal_if_needed(asking_player.name)
             
             # Якщо у гравця, що відповів, не залишилось карт, він бере нову з колоди
-            await self.check_and_deal_if_needed(target_player.name)
+            self.check_and_deal_if_needed(target_player.name)
             
-            await self.check_end_game()
-            await self.notify_all_state()
+            self.check_end_game()
+            self.notify_all_state()
             
             self.asking_player = asking_player_name
             self.target_player = None
             self.asked_rank = None
+            self.phase = 'ask'
             # Додаємо першу лінію перевірки, що гра закінчилася вже
             if not self.game_started:
                 return
-            await self.notify_all(f"Гравець {asking_player_name} продовжує свій хід.")
+            self.notify_all(f"Гравець {asking_player_name} продовжує свій хід.")
 
         else: # тут теж додано стосовно set(target_suits)
-            await self.notify_all(f"Гравець {asking_player.name} не вгадав масті {set(target_suits)} і бере карту з колоди.")
-            await self.draw_card_and_check_sets(asking_player)  #, self.asked_rank)
+            self.notify_all(f"Гравець {asking_player.name} не вгадав масті {suits_of(target_suits)} і бере карту з колоди.")
+            self.draw_card_and_check_sets(asking_player)  #, self.asked_rank)
             
         # Після того, як карти були передані, перевіряємо, чи не закінчилася гра
-        if await self.check_end_game():
+        if self.check_end_game():
         # Якщо гра закінчилася, виходимо з функції
             return
-        await self.notify_all_state()
+        self.notify_all_state()
 
 
+    def snapshot(self):
+        """Компактний знімок стану гри для сховища кімнат."""
+        return codec.dumps({
+            'seed': self.seed,
+            'started': self.game_started,
+            'finished': self.finished,
+            'deck': bytes(self.deck.cards[self.deck.position:]).hex(),
+            'players': [[p.name, p.hand.mask, p.collected_sets, p.session, p.is_bot] for p in self.players.values()],
+            'turn': self.current_turn_index,
+            'ask': [self.asking_player, self.target_player, self.asked_rank],
+            'phase': self.phase,
+            'admin': self.room_admin,
+            'version': self.state_version,
+            'seq': self.event_seq,
+            'journal': self.journal,
+        })
+
+    @classmethod
+    def restore(cls, snapshot):
+        """Відновлює гру зі знімка; гравці чекають на повернення без з'єднання."""
+        data = codec.loads(snapshot)
+        game = cls(seed=data['seed'])
+        # Стан генератора не зберігається: без перезасівання перша гра після перезапуску
+        # повторила б колоду першої гри кімнати. Номер події робить новий seed відтворюваним.
+        game.rng.seed(f"{data['seed']}:{data['seq']}")
+        game.game_started = data['started']
+        # Завершена гра закривається за FINISHED_ROOM_TTL, а не за ROOM_IDLE_TTL
+        game.finished = data.get('finished', False)
+        game.deck.cards = list(bytes.fromhex(data['deck']))
+        game.deck.position = 0
+        for name, hand_mask, collected_sets, session, *rest in data['players']:
+            is_bot = bool(rest and rest[0])
+            player = BotPlayer(name, random.Random(game.rng.random())) if is_bot else Player(name, None)
+            player.hand = Hand.from_mask(hand_mask)
+            player.collected_sets = collected_sets
+            player.session = session
+            if not is_bot:
+                player.disconnected_at = time.monotonic()
+            game.players[name] = player
+        game.current_turn_index = data['turn']
+        game.asking_player, game.target_player, game.asked_rank = data['ask']
+        game.phase = data.get('phase', 'ask')
+        game.room_admin = data['admin']
+        game.state_version = data['version']
+        game.event_seq = data['seq']
+        game.journal = [tuple(event) for event in data.get('journal', ())]
+        return game
+
     def get_state(self):
-        player_list = [{'name': p.name, 'is_turn': p.name == self.asking_player, 'collected_boxes': len(p.collected_sets), 'collected_sets': p.collected_sets} for p in self.players.values()]
+        player_list = [{'name': p.name, 'is_turn': p.name == self.asking_player, 'collected_boxes': len(p.collected_sets), 'collected_sets': list(p.collected_sets), 'is_bot': p.is_bot} for p in self.players.values()]
         return {
             'game_started': self.game_started,
             'players': player_list,
-            'deck_size': len(self.deck.cards),
+            'deck_size': len(self.deck),
             'current_turn': self.asking_player,
             'room_admin': self.room_admin
         }
 
-    async def notify_all_state(self):
+    @metrics.timed
+    def notify_all_state(self):
+        # Стан лише позначається як змінений: у пакет потрапить один фінальний знімок
+        self._state_dirty = True
+
+    def request_snapshot(self, player_name):
+        """Клієнт втратив версію (розрив або пропуск) - наступним буде повний знімок."""
+        player = self.players.get(player_name)
+        if player:
+            player.state_version = None
+            player.last_hand = None
+            self._state_dirty = True
+
+    @metrics.timed
+    def _build_state_frames(self):
+        """Повертає {ім'я гравця: кадр стану} - дельту або повний знімок.
+
+        Публічний стан будується й порівнюється один раз на пакет; дельту отримує
+        лише гравець, чия версія збігається з попередньою версією кімнати.
+        """
         state = self.get_state()
-        for player in self.players.values():
+        base_version = self.state_version
+        public_patch = diff_state(self._last_state, state) if self._last_state is not None else None
+        # Боти й відключені гравці кадрів не отримують, тож їхні руки версію не змінюють
+        connected = [p for p in self.players.values() if p.websocket is not None]
+        # Гравцю без версії (last_hand None) і так піде знімок, тож його рука нову версію не потребує
+        hands_changed = any(p.last_hand is not None and p.hand.mask != p.last_hand for p in connected)
+        if not public_patch and not hands_changed and self._last_state is not None:
+            # Нічого не змінилось, але гравцям без актуальної версії все одно шлемо знімок
+            if all(p.state_version == base_version for p in connected):
+                return {}
+        else:
+            self.state_version += 1
+        self._last_state = state
+        version = self.state_version
+
+        # Спільну частину знімка серіалізуємо один раз, а руку кожного гравця дописуємо в кінець
+        snapshot_prefix = None
+        frames = {}
+        for p in connected:
+            if p.state_version == version and p.hand.mask == p.last_hand:
+                continue
+            if p.state_version == base_version and p.last_hand is not None and public_patch is not None:
+                patch = list(public_patch)
+                if p.hand.mask != p.last_hand:
+                    patch.append({'op': 'replace', 'path': '/my_hand', 'value': p.hand.to_strings()})
+                # Порожню дельту не шлемо: клієнт уже має цей стан, а наступна дельта піде від його версії
+                if patch:
+                    frames[p.name] = codec.STATE_PATCH.encode(p.sent_version, version, patch)
+                    p.sent_version = version
+            else:
+                if snapshot_prefix is None:
+                    snapshot_prefix = codec.dumps(state)[:-1] + ',"my_hand":'
+                frames[p.name] = codec.UPDATE_STATE.render(
+                    str(version), snapshot_prefix + codec.dumps(p.hand.to_strings()) + '}'
+                )
+                p.sent_version = version
+            p.state_version = version
+            p.last_hand = p.hand.mask
+        return frames
+
+    @metrics.timed
+    def notify_all(self, message):
+        if not self.headless:
+            self._emit(None, codec.LOG.encode(message), 'log')
+
+    def send_to(self, player_name, message):
+        """Ставить у чергу повідомлення, адресоване лише одному гравцю."""
+        if not self.headless:
+            self._emit(player_name, codec.dumps(message), message['type'])
+
+    def _emit(self, recipient, payload, kind):
+        if self.headless:
+            return
+        metrics.messages_out.inc(kind)
+        self.event_seq += 1
+        self._outbox.append((recipient, payload))
+        self._history.append((self.event_seq, recipient, payload))
+
+    async def flush(self):
+        """Відправляє все накопичене одним пакетом {'type': 'batch'} на гравця."""
+        events, self._outbox = self._outbox, []
+        state_dirty, self._state_dirty = self._state_dirty, False
+        if not events and not state_dirty:
+            return
+
+        state_frames = self._build_state_frames() if state_dirty else {}
+
+        # Connection.send лише ставить кадр у чергу; затримку і таймаути рахує задача-писар з'єднання
+        for p in self.players.values():
+            if p.websocket is None:
+                continue
+            frame = [payload for recipient, payload in events if recipient is None or recipient == p.name]
+            if p.name in state_frames:
+                frame.append(state_frames[p.name])
+            if not frame:
+                continue
             try:
-                player_state = {**state, 'my_hand': player.hand}
-                await player.websocket.send(json.dumps({'type': 'update_state', 'state': player_state}))
-            except websockets.exceptions.ConnectionClosedError:
-                logger.warning(f"Failed to send state update to {player.name}, connection closed.")
+                await p.websocket.send(codec.BATCH.render(str(self.event_seq), '[' + ','.join(frame) + ']'))
+            except websockets.exceptions.ConnectionClosed:
+                logger.warning("Failed to send message to %s, connection closed.", p.name)
+                metrics.send_failures.inc('closed')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Fan-out stats: %s", self.fanout_stats.as_dict())
+
+
+def append_game_log(path, room_id, journal):
+    """Дописує журнал завершеної гри одним рядком JSON (формат читає replay.load)."""
+    try:
+        with open(path, 'a', encoding='utf-8') as log_file:
+            log_file.write(codec.dumps({'room': room_id, 'events': journal}) + '\n')
+    except OSError:
+        logger.exception("Could not write game log for room %s", room_id)
+
+
+class Room:
+    """Актор кімнати: одна задача по черзі застосовує команди гравців до Game.
 
+    Зміна стану (Room.apply) синхронна, тож дві команди ніколи не перемішуються;
+    розсилка накопиченого відбувається вже після застосування команди.
+    """
 
-    async def notify_all(self, message):
-        for player in self.players.values():
+    def __init__(self, room_id, game=None):
+        self.room_id = room_id
+        self.game = game if game is not None else Game()
+        self.commands = asyncio.Queue()
+        self.last_active = time.monotonic()
+        self.closing = False
+        self.bot_scheduled = False
+        self.task = asyncio.create_task(self.run())
+        # Гравці відновленої кімнати мають RESUME_GRACE, щоб повернутися
+        for player in self.game.players.values():
+            if player.websocket is None and not player.is_bot:
+                self.schedule_expiry(player.name, player.disconnected_at)
+        self.schedule_bot()
+
+    def schedule_expiry(self, player_name, disconnected_at):
+        asyncio.get_running_loop().call_later(
+            RESUME_GRACE, self.submit, player_name, {'type': 'expire', 'disconnected_at': disconnected_at}
+        )
+
+    @property
+    def free_seats(self):
+        """Скільки гравців ще можуть приєднатися (0, якщо гра йде або кімната закривається)."""
+        if self.closing or self.game.game_started:
+            return 0
+        return MAX_PLAYERS - len(self.game.players)
+
+    def memory_usage(self):
+        """Приблизна пам'ять стану кімнати, байти."""
+        return deep_sizeof(self.game)
+
+    def schedule_bot(self):
+        """Якщо гра чекає на бота, ставить його хід у чергу через BOT_DELAY."""
+        if not self.bot_scheduled and self.game.waiting_for_bot() is not None:
+            self.bot_scheduled = True
+            asyncio.get_running_loop().call_later(BOT_DELAY, self.submit, None, {'type': 'bot'})
+
+    def submit(self, player_name, data, websocket=None):
+        """Ставить команду в чергу кімнати і повертає future з її результатом."""
+        future = asyncio.get_running_loop().create_future()
+        if self.task.done():
+            # Кімнату вже закрито: команду ніхто не виконає
+            future.set_result((False, "Кімнату закрито."))
+            return future
+        self.commands.put_nowait((player_name, data, websocket, future))
+        return future
+
+    async def run(self):
+        try:
+            await self._run()
+        finally:
+            # Команди, що стояли в черзі за закриттям, отримують відмову - інакше обробники чекали б вічно
+            while not self.commands.empty():
+                *_, future = self.commands.get_nowait()
+                if not future.done():
+                    future.set_result((False, "Кімнату закрито."))
+
+    async def _run(self):
+        while True:
+            player_name, data, websocket, future = await self.commands.get()
+            self.last_active = time.monotonic()
+            started = time.perf_counter()
+            was_finished = self.game.finished
             try:
-                await player.websocket.send(json.dumps({'type': 'log', 'message': message}))
-            except websockets.exceptions.ConnectionClosedError:
-                logger.warning(f"Failed to send log message to {player.name}, connection closed.")
+                result = self.apply(player_name, data, websocket)
+            except Exception as e:
+                logger.exception("Command %s from %s failed in room %s", data.get('type'), player_name, self.room_id)
+                result = e
+            if GAME_LOG and self.game.finished and not was_finished:
+                append_game_log(GAME_LOG, self.room_id, self.game.journal)
+            metrics.command_seconds.observe(time.perf_counter() - started, data['type'])
+            if not future.done():
+                future.set_result(result)
+            # Усе, що накопичилось за час обробки команди, йде одним пакетом
+            try:
+                await self.game.flush()
+            except Exception:
+                logger.exception("Flush failed in room %s", self.room_id)
+            if snapshot_writer is not None:
+                snapshot_writer.mark_dirty(self.room_id)
 
+            if self.closing:
+                # Прощальне повідомлення вже в черзі з'єднань; закриваємо їх, коли його буде дописано
+                for player in self.game.players.values():
+                    if isinstance(player.websocket, Connection):
+                        player.websocket.close(1001, "Room closed", drain=True)
+                return
+            # Між перевіркою та видаленням немає await, тож нова команда не загубиться
+            if not self.game.players and self.commands.empty():
+                rooms.discard(self)
+                logger.info("Кімната %s закрита, оскільки всі гравці вийшли.", self.room_id)
+                return
+            rooms.update_index(self)
+            self.schedule_bot()
+
+    def apply(self, player_name, data, websocket):
+        game = self.game
+        if data['type'] == 'join':
+            success, msg = game.add_player(player_name, websocket)
+            if success:
+                logger.info("Гравець %s приєднався до кімнати %s", player_name, self.room_id)
+                game.send_to(player_name, {'type': 'joined_room', 'room': self.room_id,
+                                           'session': game.players[player_name].session})
+                game.notify_all(f"Гравець {player_name} приєднався до гри.")
+                game.notify_all_state()
+            return success, msg
+
+        if data['type'] == 'resume':
+            success, msg = game.resume_player(player_name, data['session'], websocket, data['last_seq'])
+            if success:
+                logger.info("Гравець %s відновив сесію в кімнаті %s", player_name, self.room_id)
+                game.notify_all(msg)
+                game.notify_all_state()
+            return success, msg
+
+        if data['type'] == 'leave':
+            disconnected_at = game.disconnect_player(player_name, websocket)
+            if disconnected_at is None:
+                return True
+            if not game.game_started:
+                # До початку гри місце не бережемо: ім'я й адмін одразу вільні, як і раніше
+                game.remove_player(player_name)
+                if all(p.is_bot for p in game.players.values()):
+                    game.players.clear()
+                game.notify_all(f"Гравець {player_name} відключився.")
+                game.notify_all_state()
+            else:
+                game.notify_all(f"Гравець {player_name} втратив з'єднання.")
+                self.schedule_expiry(player_name, disconnected_at)
+            return True
+
+        if data['type'] == 'expire':
+            player = game.players.get(player_name)
+            # Таймер застарів, якщо гравець уже повернувся (і, можливо, знову відключився)
+            if player is not None and player.disconnected_at == data['disconnected_at']:
+                if game.game_started:
+                    game.replace_with_bot(player_name)
+                    game.notify_all(f"Гравець {player_name} не повернувся, за нього грає бот.")
+                else:
+                    game.remove_player(player_name)
+                    game.notify_all(f"Гравець {player_name} відключився.")
+                if all(p.is_bot for p in game.players.values()):
+                    # Самі боти кімнату не тримають
+                    game.players.clear()
+                game.notify_all_state()
+            return True
+
+        if data['type'] == 'bot':
+            self.bot_scheduled = False
+            game.play_bot()
+            return True
+
+        if data['type'] == 'close':
+            # Після цього кімната не приймає нових гравців: менеджер уже створить нову з тим самим id
+            self.closing = True
+            rooms.discard(self)
+            game.notify_all(data['reason'])
+            logger.info("Кімната %s закрита: %s", self.room_id, data['reason'])
+            return True
+
+        if data['type'] == 'start_game' and player_name == game.room_admin:
+            if not game.start_game():
+                game.send_to(player_name, {'type': 'error', 'message': "Недостатньо гравців."})
+
+        elif data['type'] == 'add_bot' and player_name == game.room_admin:
+            success, msg = game.add_bot()
+            if success:
+                game.notify_all(msg)
+                game.notify_all_state()
+            else:
+                game.send_to(player_name, {'type': 'error', 'message': msg})
+
+        # Хід приймається лише у фазі, на яку гра чекає: інакше застаріла чи повторна дія зламала б хід
+        elif data['type'] == 'ask_card' and player_name == game.asking_player and game.phase == 'ask':
+            game.handle_ask_card(player_name, data['target'], data['card_rank'])
+
+        elif data['type'] == 'ask_response' and player_name == game.target_player and game.phase == 'response':
+            game.handle_ask_response(player_name, data['response'])
+
+        elif data['type'] == 'guess_count' and player_name == game.asking_player and game.phase == 'guess_count':
+            game.handle_guess_count(player_name, data['count'])
+
+        elif data['type'] == 'guess_suits' and player_name == game.asking_player and game.phase == 'guess_suits':
+            game.handle_guess_suits(player_name, data['suits'])
+
+        elif data['type'] == 'resync':
+            game.request_snapshot(player_name)
+
+        elif data['type'] == 'replay':
+            player = game.players.get(player_name)
+            if player is not None and isinstance(player.websocket, Connection):
+                player.websocket.replaying = False
+                game.replay_missed(player_name, data['last_seq'])
+        return True
+
+
+def deep_sizeof(obj, _seen=None):
+    """Приблизний розмір об'єкта гри разом із вкладеними контейнерами, байти.
+
+    Рахуються лише контейнери, прості значення та об'єкти гри; сокети, задачі
+    й інші спільні з рештою процесу об'єкти пропускаються.
+    """
+    seen = set() if _seen is None else _seen
+    if id(obj) in seen or not isinstance(obj, _SIZED_TYPES):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    else:
+        size += sum(deep_sizeof(getattr(obj, name, None), seen) for name in getattr(obj, '__slots__', ()))
+    return size
+
+
+_SIZED_TYPES = (
+    str, bytes, int, float, type(None), dict, list, tuple, set, frozenset, deque, random.Random,
+    Game, Player, Hand, Deck, FanoutStats, Connection,
+)
+
+
+class TimerWheel:
+    """Хешоване колесо таймерів: додавання та спрацювання за O(1) незалежно від кількості кімнат.
+
+    Один слот - tick секунд; таймер, довший за оберт колеса, пролежить у слоті
+    потрібну кількість обертів. Скасування немає: власник перевіряє актуальність
+    таймера, коли той спрацює.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = 0
+
+    def schedule(self, item, delay):
+        ticks = max(1, -int(-delay // self.tick))
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        self.slots[(self.position + offset + 1) % len(self.slots)].append((rounds, item))
+
+    def advance(self):
+        """Зсуває колесо на один слот і повертає елементи, чий час настав."""
+        self.position = (self.position + 1) % len(self.slots)
+        slot = self.slots[self.position]
+        self.slots[self.position] = [(rounds - 1, item) for rounds, item in slot if rounds > 0]
+        return [item for rounds, item in slot if rounds == 0]
+
+
+class RoomManager:
+    """Усі кімнати процесу: ліміт кількості, закриття неактивних і лобі відкритих кімнат.
+
+    Відкриті кімнати індексуються за кількістю вільних місць і оновлюються після
+    кожної команди кімнати, тож пошук кімнати для швидкої гри не перебирає всі.
+    """
+
+    def __init__(self, max_rooms=MAX_ROOMS, idle_ttl=ROOM_IDLE_TTL, finished_ttl=FINISHED_ROOM_TTL):
+        self.max_rooms = max_rooms
+        self.idle_ttl = idle_ttl
+        self.finished_ttl = finished_ttl
+        self.rooms = {}
+        # by_free_seats[n] - відкриті кімнати з n вільними місцями в порядку створення
+        self.by_free_seats = [{} for _ in range(MAX_PLAYERS + 1)]
+        self._seats = {}
+        self.wheel = TimerWheel()
+        self.reaper = None
+        # (індекс воркера, кількість воркерів) у шардованому режимі
+        self.shard = None
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def __contains__(self, room_id):
+        return room_id in self.rooms
+
+    def __iter__(self):
+        return iter(self.rooms.values())
+
+    def get(self, room_id):
+        return self.rooms.get(room_id)
+
+    def get_or_create(self, room_id):
+        """Повертає кімнату, створюючи її за потреби; None, якщо досягнуто max_rooms."""
+        room = self.rooms.get(room_id)
+        if room is None:
+            if len(self.rooms) >= self.max_rooms:
+                return None
+            room = self.add(Room(room_id))
+        return room
+
+    def add(self, room):
+        self.rooms[room.room_id] = room
+        self.update_index(room)
+        self.wheel.schedule(room, min(self.idle_ttl, self.finished_ttl))
+        return room
+
+    def discard(self, room):
+        if self.rooms.get(room.room_id) is room:
+            del self.rooms[room.room_id]
+            self._unindex(room.room_id)
+
+    def update_index(self, room):
+        if self.rooms.get(room.room_id) is not room:
+            return
+        seats = room.free_seats
+        if self._seats.get(room.room_id) == seats:
+            return
+        self._unindex(room.room_id)
+        if seats > 0:
+            self.by_free_seats[seats][room.room_id] = room
+            self._seats[room.room_id] = seats
+
+    def _unindex(self, room_id):
+        seats = self._seats.pop(room_id, None)
+        if seats is not None:
+            del self.by_free_seats[seats][room_id]
+
+    def find_open(self):
+        """Найзаповненіша кімната, до якої ще можна приєднатися, або None."""
+        for bucket in self.by_free_seats[1:]:
+            for room in bucket.values():
+                return room
+        return None
+
+    def new_room_id(self):
+        """Випадковий id нової кімнати; у шардованому режимі - такий, що належить цьому воркеру."""
+        while True:
+            room_id = secrets.token_urlsafe(6)
+            if self.shard is None or shard_for(room_id, self.shard[1]) == self.shard[0]:
+                return room_id
+
+    def lobby(self, limit=50):
+        """Відкриті кімнати для списку в лобі: спершу ті, де лишилось найменше місць."""
+        listing = []
+        for seats, bucket in enumerate(self.by_free_seats):
+            for room in bucket.values():
+                if len(listing) >= limit:
+                    return listing
+                listing.append({'room': room.room_id, 'players': len(room.game.players), 'free_seats': seats})
+        return listing
+
+    def memory_report(self, limit=20):
+        """Найбільші за пам'яттю кімнати: [(room_id, байти)], від більшої."""
+        sizes = sorted(((room.memory_usage(), room.room_id) for room in self.rooms.values()), reverse=True)
+        return [(room_id, size) for size, room_id in sizes[:limit]]
+
+    def estimated_memory(self, sample=32):
+        """Оцінка пам'яті всіх кімнат за випадковою вибіркою (для метрики, щоб збір був дешевим)."""
+        if not self.rooms:
+            return 0
+        picked = random.sample(list(self.rooms.values()), min(sample, len(self.rooms)))
+        return sum(room.memory_usage() for room in picked) / len(picked) * len(self.rooms)
+
+    def start(self):
+        self.reaper = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            for room in self.wheel.advance():
+                self.check_idle(room)
+
+    def check_idle(self, room):
+        if self.rooms.get(room.room_id) is not room:
+            return
+        ttl = self.finished_ttl if room.game.finished else self.idle_ttl
+        remaining = room.last_active + ttl - time.monotonic()
+        if remaining > 0:
+            # Гра може завершитися до наступної перевірки, тож не чекаємо довше за finished_ttl
+            self.wheel.schedule(room, min(remaining, self.finished_ttl))
+        elif room.game.finished:
+            room.submit(None, {'type': 'close', 'reason': "Кімнату закрито після завершення гри."})
+        else:
+            room.submit(None, {'type': 'close', 'reason': "Кімнату закрито через неактивність."})
+
+
+rooms = RoomManager()
+
+metrics.registry.gauge('skrynky_rooms_alive', "Rooms held by this process.", lambda: len(rooms))
+metrics.registry.gauge('skrynky_rooms_open', "Rooms with free seats.", lambda: sum(len(bucket) for bucket in rooms.by_free_seats))
+metrics.registry.gauge(
+    'skrynky_rooms_memory_bytes', "Estimated memory held by room state (sampled).", rooms.estimated_memory
+)
+metrics.registry.gauge(
+    'skrynky_players_connected', "Players with an open connection.",
+    lambda: sum(p.websocket is not None for room in rooms for p in room.game.players.values()),
+)
+metrics.registry.gauge(
+    'skrynky_outbox_depth', "Frames waiting in client outboxes.",
+    lambda: sum(len(p.websocket.queue) for room in rooms for p in room.game.players.values()
+                if isinstance(p.websocket, Connection)),
+)
+metrics.registry.gauge(
+    'skrynky_room_queue_depth', "Commands waiting in room actor queues.",
+    lambda: sum(room.commands.qsize() for room in rooms),
+)
+
+
+class RoomStore:
+    """Сховище знімків кімнат. Базовий клас нічого не зберігає."""
+
+    def load_all(self):
+        """Повертає {room_id: знімок} усіх збережених кімнат."""
+        return {}
+
+    def save_many(self, snapshots):
+        """Записує {room_id: знімок}; знімок None означає, що кімнату треба видалити."""
+
+    def close(self):
+        pass
+
+
+class SqliteRoomStore(RoomStore):
+    """Локальне сховище в одному SQLite-файлі; кожна пачка знімків - одна транзакція."""
+
+    def __init__(self, path):
+        # Запис виконується з потоку SnapshotWriter, тому з'єднання не прив'язане до потоку
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS rooms (room_id TEXT PRIMARY KEY, snapshot TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def load_all(self):
+        return dict(self.connection.execute("SELECT room_id, snapshot FROM rooms"))
+
+    def save_many(self, snapshots):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO rooms (room_id, snapshot, updated) VALUES (?, ?, ?)",
+                [(room_id, snapshot, now) for room_id, snapshot in snapshots.items() if snapshot is not None],
+            )
+            self.connection.executemany(
+                "DELETE FROM rooms WHERE room_id = ?",
+                [(room_id,) for room_id, snapshot in snapshots.items() if snapshot is None],
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+class SnapshotWriter:
+    """Відкладений запис: кімнати лише позначаються як змінені, а знімки пишуться пачками у фоні."""
+
+    def __init__(self, store, interval=SNAPSHOT_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self.dirty = set()
+        self.task = None
+        # Поточний фоновий запис: потік не зупиняється разом із задачею, тож close на нього чекає
+        self.saving = None
+
+    def mark_dirty(self, room_id):
+        self.dirty.add(room_id)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            snapshots = self.collect()
+            if snapshots:
+                self.saving = asyncio.create_task(self.save(snapshots))
+                await asyncio.shield(self.saving)
+
+    async def save(self, snapshots):
+        try:
+            await asyncio.to_thread(self.store.save_many, snapshots)
+        except Exception:
+            logger.exception("Failed to save %d room snapshots", len(snapshots))
+            self.dirty.update(snapshots)
+
+    def collect(self):
+        # Знімки робляться в циклі подій, тож вони узгоджені з командами кімнати
+        dirty, self.dirty = self.dirty, set()
+        return {
+            room_id: rooms.get(room_id).game.snapshot() if room_id in rooms else None
+            for room_id in dirty
+        }
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.saving is not None:
+            # Інакше останній запис і закриття сховища йшли б паралельно з потоком на тому самому з'єднанні
+            await self.saving
+        snapshots = self.collect()
+        if snapshots:
+            self.store.save_many(snapshots)
+        self.store.close()
+
+
+snapshot_writer = None
+
+
+def start_persistence(path):
+    """Відкриває сховище, відновлює збережені кімнати і запускає фоновий запис."""
+    global snapshot_writer
+    if not path:
+        return None
+    store = SqliteRoomStore(path)
+    for room_id, snapshot in store.load_all().items():
+        try:
+            # Відновлені кімнати існували до перезапуску, тож ліміт max_rooms на них не діє
+            rooms.add(Room(room_id, Game.restore(snapshot)))
+        except (ValueError, KeyError, TypeError):
+            logger.exception("Could not restore room %s", room_id)
+    logging.info(f"Restored {len(rooms)} rooms from {path}")
+    snapshot_writer = SnapshotWriter(store)
+    snapshot_writer.start()
+    return snapshot_writer
+
+
+async def stop_persistence():
+    global snapshot_writer
+    if snapshot_writer is not None:
+        await snapshot_writer.close()
+        snapshot_writer = None
 
-game_rooms = {}
 
 async def handler(websocket):
     player_name = None
-    room_id = None
+    room = None
+    connection = Connection(websocket)
+    bucket = TokenBucket(INBOUND_RATE, INBOUND_BURST)
+    rejected = 0
     try:
         async for message in websocket:
-            data = json.loads(message)
+            if connection.closed:
+                # З'єднання закрите сервером (сесію перехопило інше, клієнта відключено): команди вже не приймаємо
+                break
+            if not bucket.allow():
+                # Повідомлення понад ліміт відкидаються; стійкий флуд закриває з'єднання
+                metrics.rate_limited.inc()
+                rejected += 1
+                if rejected > INBOUND_BURST:
+                    logger.warning("Closing %s: inbound rate limit exceeded.", player_name)
+                    await websocket.close(1008, "Rate limit exceeded")
+                    break
+                continue
+            rejected = max(0, rejected - 1)
+
+            try:
+                data = codec.decode_inbound(message)
+            except codec.CodecError as e:
+                metrics.messages_in.inc('invalid')
+                await connection.send(codec.dumps({'type': 'error', 'message': str(e)}))
+                continue
+            metrics.messages_in.inc(data['type'])
             
-            if data['type'] == 'join':
-                player_name = data['name']
-                room_id = data['room']
-
-                if room_id not in game_rooms:
-                    game_rooms[room_id] = Game()
-                
-                game = game_rooms[room_id]
-                success, msg = await game.add_player(player_name, websocket)
-                
+            if data['type'] == 'list_rooms':
+                await connection.send(codec.dumps({'type': 'room_list', 'rooms': rooms.lobby()}))
+
+            elif data['type'] in ('join', 'resume', 'quick_join'):
+                if room is not None:
+                    continue
+                if data['type'] == 'quick_join':
+                    # Найзаповненіша відкрита кімната, а якщо такої немає - нова
+                    open_room = rooms.find_open()
+                    room_id = open_room.room_id if open_room is not None else rooms.new_room_id()
+                    data = {'type': 'join', 'name': data['name'], 'room': room_id}
+                if rooms.shard is not None and shard_for(data['room'], rooms.shard[1]) != rooms.shard[0]:
+                    # Кімната належить іншому воркеру: тут вона стала б другою кімнатою з тим самим id
+                    await connection.send(codec.dumps({'type': 'error', 'message': "Кімната недоступна, спробуйте ще раз."}))
+                    continue
+                candidate = rooms.get_or_create(data['room'])
+                if candidate is None:
+                    await connection.send(codec.dumps({'type': 'error', 'message': "Сервер переповнений, спробуйте пізніше."}))
+                    continue
+                success, msg = await candidate.submit(data['name'], data, connection)
                 if success:
-                    logger.info(f"Гравець {player_name} приєднався до кімнати {room_id}")
-                    await websocket.send(json.dumps({'type': 'joined_room'}))
-                    await game.notify_all(f"Гравець {player_name} приєднався до гри.")
-                    await game.notify_all_state()
+                    player_name = data['name']
+                    room = candidate
+                    connection.name = player_name
+                    connection.fanout_stats = room.game.fanout_stats
+                    # Після переповнення черги кімната повторить пропущене і надішле повний знімок
+                    connection.on_overflow = lambda seq: room.submit(player_name, {'type': 'replay', 'last_seq': seq})
+                elif data['type'] == 'resume':
+                    await connection.send(codec.dumps({'type': 'resume_failed', 'message': msg}))
                 else:
-                    await websocket.send(json.dumps({'type': 'error', 'message': msg}))
-            
-            if player_name and room_id and room_id in game_rooms:
-                game = game_rooms[room_id]
-                if data['type'] == 'start_game' and player_name == game.room_admin:
-                    if await game.start_game():
-                        pass
+                    await connection.send(codec.dumps({'type': 'error', 'message': msg}))
+
+            elif room is not None:
+                # Стан гри змінює лише задача кімнати; з'єднання тільки ставить команду в чергу
+                room.submit(player_name, data)
+
+    except websockets.exceptions.ConnectionClosed:
+        logger.info("З'єднання закрито для гравця %s в кімнаті %s", player_name, room and room.room_id)
+    finally:
+        if room is not None:
+            room.submit(player_name, {'type': 'leave'}, connection)
+        connection.close()
+
+def shard_for(room_id, workers):
+    """Номер воркера, якому належить кімната (стабільний між процесами, на відміну від hash())."""
+    return zlib.crc32(str(room_id).encode('utf-8')) % workers
+
+
+async def _worker_lobby(port):
+    async with websockets.connect(f"ws://127.0.0.1:{port}") as upstream:
+        await upstream.send(codec.dumps({'type': 'list_rooms'}))
+        return codec.loads(await upstream.recv())['rooms']
+
+
+async def gather_lobby(worker_ports, limit=50):
+    """Лобі всіх воркерів разом, у тому ж порядку, що й RoomManager.lobby."""
+    listings = await asyncio.gather(*(_worker_lobby(port) for port in worker_ports), return_exceptions=True)
+    merged = [room for listing in listings if not isinstance(listing, BaseException) for room in listing]
+    merged.sort(key=lambda room: room['free_seats'])
+    return merged[:limit]
+
+
+async def router(websocket, worker_ports):
+    """Фронт шардованого режиму: проксює з'єднання до воркера, якому належить кімната.
+
+    Поки клієнт не в кімнаті, кожен join/resume веде до воркера кімнати (shard_for),
+    а quick_join - до найзаповненішої відкритої кімнати серед усіх воркерів; якщо
+    вхід не вдався, наступна спроба може піти вже до іншого воркера. Після входу
+    (joined_room від воркера) повідомлення лише пересилаються. Лобі збирається з
+    усіх воркерів.
+    """
+    upstream = upstream_port = downstream = None
+    joined = False
+
+    async def forward(source):
+        nonlocal joined
+        async for message in source:
+            if not joined and '"joined_room"' in message:
+                joined = True
+            await websocket.send(message)
+        # Воркер закрив з'єднання (кімнату закрито, клієнта відключено) - закриваємо і клієнта
+        code = source.close_code
+        if code in (None, 1005, 1006, 1015):
+            # Ці коди не можна передати у кадрі закриття
+            code = 1000 if code in (None, 1005) else 1011
+        await websocket.close(code, source.close_reason or "")
+
+    try:
+        async for message in websocket:
+            if not joined or '"list_rooms"' in message:
+                try:
+                    data = codec.decode_inbound(message)
+                except codec.CodecError as e:
+                    await websocket.send(codec.dumps({'type': 'error', 'message': str(e)}))
+                    continue
+                if data['type'] == 'list_rooms':
+                    await websocket.send(codec.dumps({'type': 'room_list', 'rooms': await gather_lobby(worker_ports)}))
+                    continue
+                if data['type'] == 'quick_join':
+                    lobby = await gather_lobby(worker_ports, limit=1)
+                    if lobby:
+                        data = {'type': 'join', 'name': data['name'], 'room': lobby[0]['room']}
+                        message = codec.dumps(data)
+                if not joined and data['type'] in ('join', 'resume', 'quick_join'):
+                    if data['type'] == 'quick_join':
+                        # Відкритих кімнат немає: воркер створить нову кімнату зі свого шарда
+                        port = random.choice(worker_ports)
                     else:
-                        await websocket.send(json.dumps({'type': 'error', 'message': "Недостатньо гравців."}))
-                
-                elif data['type'] == 'ask_card' and player_name == game.asking_player:
-                    await game.handle_ask_card(player_name, data['target'], data['card_rank'])
-                
-                elif data['type'] == 'ask_response' and player_name == game.target_player:
-                    await game.handle_ask_response(player_name, data['response'])
-                
-                elif data['type'] == 'guess_count' and player_name == game.asking_player:
-                    await game.handle_guess_count(player_name, data['count'])
-                
-                elif data['type'] == 'guess_suits' and player_name == game.asking_player:
-                    await game.handle_guess_suits(player_name, data['suits'])
-
-    except websockets.exceptions.ConnectionClosedError:
-        logger.info(f"З'єднання закрито для гравця {player_name} в кімнаті {room_id}")
+                        port = worker_ports[shard_for(data['room'], len(worker_ports))]
+                    if port != upstream_port:
+                        if upstream is not None:
+                            downstream.cancel()
+                            await upstream.close()
+                        upstream = await websockets.connect(f"ws://127.0.0.1:{port}")
+                        upstream_port = port
+                        downstream = asyncio.create_task(forward(upstream))
+            if upstream is not None:
+                await upstream.send(message)
+    except websockets.exceptions.ConnectionClosed:
+        pass
     finally:
-        if player_name and room_id and room_id in game_rooms:
-            game = game_rooms[room_id]
-            game.remove_player(player_name)
-            if not game.players:
-                del game_rooms[room_id]
-                logger.info(f"Кімната {room_id} закрита, оскільки всі гравці вийшли.")
-            else:
-                await game.notify_all(f"Гравець {player_name} відключився.")
-                await game.notify_all_state()
+        if downstream is not None:
+            downstream.cancel()
+            await asyncio.gather(downstream, return_exceptions=True)
+        if upstream is not None:
+            await upstream.close()
+
+
+async def _rooms_view(request):
+    """GET /debug/rooms?limit=20 - кількість кімнат, лобі та найбільші кімнати за пам'яттю."""
+    limit = metrics.query_number(request, 'limit', 20, 1, 1000, int)
+    report = {
+        'rooms': len(rooms),
+        'max_rooms': rooms.max_rooms,
+        'open': rooms.lobby(limit),
+        'largest': [{'room': room_id, 'bytes': size} for room_id, size in rooms.memory_report(limit)],
+    }
+    return web.Response(text=codec.dumps(report), content_type='application/json', charset='utf-8')
+
+
+async def start_metrics(port):
+    if not port:
+        return None
+    logging.info(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+    app = web.Application()
+    app.router.add_get('/debug/rooms', _rooms_view)
+    return await metrics.start_endpoint(METRICS_HOST, int(port), PROFILER, app)
+
+
+def shutdown_signal():
+    """Future, що завершується на SIGTERM (так платформи розгортання зупиняють сервіс) або SIGINT.
+
+    Сервер тоді виходить зі своїх finally: дописує знімки кімнат і закриває сховище.
+    """
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+
+    def stop():
+        # Воркер отримує SIGTERM і від групи процесів, і від маршрутизатора: повторний не заважає зупинці
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        if not stopped.done():
+            stopped.set_result(None)
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop)
+    return stopped
+
+
+async def _serve_worker(index, workers, ready):
+    global GAME_LOG
+    stopped = shutdown_signal()
+    # Кожен воркер має власні файли сховища й журналу і порт метрик: кімнати між воркерами не перетинаються
+    rooms.shard = (index, workers)
+    GAME_LOG = f"{GAME_LOG}.{index}" if GAME_LOG else ""
+    rooms.start()
+    start_persistence(f"{ROOM_STORE}.{index}" if ROOM_STORE else "")
+    await start_metrics(int(METRICS_PORT) + 1 + index if METRICS_PORT else None)
+    try:
+        async with websockets.serve(handler, "127.0.0.1", 0, max_size=codec.MAX_MESSAGE_BYTES) as server:
+            ready.put((index, server.sockets[0].getsockname()[1]))
+            await stopped
+    finally:
+        await stop_persistence()
+        rooms.stop()
+
+
+def _worker_main(index, workers, ready):
+    try:
+        asyncio.run(_serve_worker(index, workers, ready))
+    except KeyboardInterrupt:
+        pass
+
+
+async def serve_public(port, ws_handler, stopped):
+    """Слухає публічний порт, доки не завершиться stopped: HTTP-фронт зі сторінками WebApp і WebSocket на / або лише WebSocket."""
+    if not HTTP_FRONTEND:
+        async with websockets.serve(ws_handler, "0.0.0.0", port, max_size=codec.MAX_MESSAGE_BYTES):
+            await stopped
+        return
+    runner = await webapp.start_frontend("0.0.0.0", port, ws_handler, codec.MAX_MESSAGE_BYTES,
+                                         keepalive_timeout=HTTP_KEEPALIVE)
+    try:
+        await stopped
+    finally:
+        await runner.cleanup()
+
+
+async def serve_sharded(port, workers, stopped):
+    """Запускає workers процесів-воркерів і маршрутизатор на спільному порту."""
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    processes = [context.Process(target=_worker_main, args=(i, workers, ready), daemon=True) for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    worker_ports = [None] * workers
+    for _ in range(workers):
+        index, worker_port = await asyncio.to_thread(ready.get)
+        worker_ports[index] = worker_port
+    logging.info(f"Started {workers} room workers on ports {worker_ports}")
+
+    try:
+        logging.info(f"Starting WebSocket router on 0.0.0.0:{port}")
+        await serve_public(port, lambda ws: router(ws, worker_ports), stopped)
+    finally:
+        # Воркери на SIGTERM дописують свої знімки й виходять самі; вбиваємо лише тих, хто завис
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        for process in processes:
+            await asyncio.to_thread(process.join, WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logging.warning(f"Worker {process.pid} did not stop in {WORKER_STOP_TIMEOUT}s, killing it")
+                process.kill()
+
 
 async def main():
     port_env = os.environ.get("PORT")
     port = int(port_env) if port_env else 8765
-    logging.info(f"Starting WebSocket server on 0.0.0.0:{port}")
-    async with websockets.serve(handler, "0.0.0.0", port):
-        await asyncio.Future()
+    # WORKERS > 1 вмикає шардований режим: кімнати розподіляються між процесами за room_id
+    workers = int(os.environ.get("WORKERS", "1"))
+    stopped = shutdown_signal()
+    if workers > 1:
+        await serve_sharded(port, workers, stopped)
+        return
+    rooms.start()
+    start_persistence(ROOM_STORE)
+    await start_metrics(METRICS_PORT)
+    try:
+        logging.info(f"Starting WebSocket server on 0.0.0.0:{port}")
+        await serve_public(port, handler, stopped)
+    finally:
+        await stop_persistence()
+        rooms.stop()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
+        logging.info("Server stopped")
     except KeyboardInterrupt:
         logging.info("Server stopped by user")
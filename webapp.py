@@ -0,0 +1,174 @@
+"""HTTP-фронт сервера "Скриньки": сторінки WebApp і WebSocket гри на одному порту.
+
+Сторінки читаються й стискаються (gzip, а якщо встановлено brotli - ще й br) один
+раз під час запуску. Відповіді мають ETag, тож повторне відкриття WebApp у
+Telegram отримує 304 без тіла; адреса з ?v=<версія> кешується назавжди
+(immutable). Запит на / з заголовком Upgrade: websocket передається обробнику
+гри через WebSocketAdapter.
+"""
+import gzip
+import hashlib
+import logging
+import os
+
+import websockets
+import websockets.exceptions
+from aiohttp import WSMsgType, web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Сторінки клієнтів; перша віддається також на /
+PAGES = ('index_webapp_final.html', 'index_1.html', 'guess.html', 'index.html')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class StaticAsset:
+    """Сторінка в пам'яті разом із заздалегідь стиснутими варіантами."""
+
+    def __init__(self, name, body, content_type='text/html'):
+        self.name = name
+        self.content_type = content_type
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        # Слабкий ETag: стиснуті варіанти мають той самий зміст
+        self.etag = f'W/"{self.version}"'
+        self.variants = {'identity': body}
+        compressed = {'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(body, quality=11)
+        for encoding, data in compressed.items():
+            if len(data) < len(body):
+                self.variants[encoding] = data
+
+    def choose_encoding(self, accept_encoding):
+        """Найменший варіант, який приймає клієнт (за заголовком Accept-Encoding)."""
+        accepted = set()
+        for item in accept_encoding.split(','):
+            coding, _, params = item.partition(';')
+            quality = params.strip().replace(' ', '')
+            if quality.startswith('q='):
+                try:
+                    if float(quality[2:]) <= 0:
+                        continue
+                except ValueError:
+                    # Некоректне q ігноруємо, як і відсутнє
+                    pass
+            accepted.add(coding.strip().lower())
+        candidates = [encoding for encoding in self.variants if encoding in accepted or '*' in accepted]
+        return min(candidates, key=lambda encoding: len(self.variants[encoding]), default='identity')
+
+    def matches(self, if_none_match):
+        return any(tag.strip().removeprefix('W/') == self.etag.removeprefix('W/') or tag.strip() == '*'
+                   for tag in if_none_match.split(','))
+
+
+def load_assets(root, pages=PAGES):
+    assets = {}
+    for name in pages:
+        path = os.path.join(root, name)
+        if not os.path.exists(path):
+            logger.warning("Page %s not found, skipping", path)
+            continue
+        with open(path, 'rb') as page_file:
+            assets[name] = StaticAsset(name, page_file.read())
+    return assets
+
+
+class WebSocketAdapter:
+    """aiohttp WebSocketResponse з інтерфейсом з'єднання websockets, на який розраховані
+    handler і router: send, recv, close і async for по вхідних повідомленнях."""
+
+    def __init__(self, ws):
+        self.ws = ws
+
+    async def send(self, message):
+        if self.ws.closed:
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        try:
+            if isinstance(message, str):
+                await self.ws.send_str(message)
+            else:
+                await self.ws.send_bytes(message)
+        except ConnectionResetError:
+            raise websockets.exceptions.ConnectionClosedError(None, None) from None
+
+    async def recv(self):
+        message = await self.ws.receive()
+        if message.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+            return message.data
+        if message.type == WSMsgType.ERROR:
+            raise websockets.exceptions.ConnectionClosedError(None, None)
+        raise websockets.exceptions.ConnectionClosedOK(None, None)
+
+    async def close(self, code=1000, reason=""):
+        await self.ws.close(code=code, message=reason.encode('utf-8'))
+
+    async def __aiter__(self):
+        while True:
+            try:
+                yield await self.recv()
+            except websockets.exceptions.ConnectionClosedOK:
+                return
+
+
+def create_app(ws_handler, root, max_message_bytes=None):
+    """aiohttp-застосунок зі сторінками з root і WebSocket-обробником ws_handler(з'єднання) на /."""
+    assets = load_assets(root)
+
+    def serve(asset):
+        async def view(request):
+            headers = {
+                'ETag': asset.etag,
+                'Vary': 'Accept-Encoding',
+                'Cache-Control': IMMUTABLE if request.query.get('v') == asset.version else 'no-cache',
+            }
+            if asset.matches(request.headers.get('If-None-Match', '')):
+                return web.Response(status=304, headers=headers)
+            encoding = asset.choose_encoding(request.headers.get('Accept-Encoding', ''))
+            if encoding != 'identity':
+                headers['Content-Encoding'] = encoding
+            return web.Response(body=asset.variants[encoding], headers=headers,
+                                content_type=asset.content_type, charset='utf-8')
+        return view
+
+    async def websocket_view(request):
+        ws = web.WebSocketResponse(max_msg_size=max_message_bytes or 0, heartbeat=20)
+        await ws.prepare(request)
+        try:
+            await ws_handler(WebSocketAdapter(ws))
+        finally:
+            if not ws.closed:
+                await ws.close()
+        return ws
+
+    index = serve(assets[PAGES[0]]) if PAGES[0] in assets else None
+
+    async def root_view(request):
+        # Клієнти підключаються до WebSocket за тією ж адресою, що й сторінка
+        if request.headers.get('Upgrade', '').lower() == 'websocket':
+            return await websocket_view(request)
+        if index is None:
+            raise web.HTTPNotFound()
+        return await index(request)
+
+    app = web.Application()
+    app.router.add_get('/', root_view)
+    for name, asset in assets.items():
+        app.router.add_get(f'/{name}', serve(asset))
+        logger.info("Serving /%s?v=%s (%s)", name, asset.version,
+                    ', '.join(f"{encoding} {len(body)} B" for encoding, body in asset.variants.items()))
+    return app
+
+
+async def start_frontend(host, port, ws_handler, max_message_bytes=None,
+                         root=os.path.dirname(os.path.abspath(__file__)), keepalive_timeout=75):
+    """Запускає HTTP-фронт і повертає його runner; з'єднання тримаються keep-alive."""
+    app = create_app(ws_handler, root, max_message_bytes)
+    runner = web.AppRunner(app, access_log=None, keepalive_timeout=keepalive_timeout)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner